@@ -0,0 +1,76 @@
+# Per-character cost of split and cmd_parse on adversarial inputs, growing up to 1 MB
+#
+#   python bench/bench_adversarial.py [--max-size 1048576] [--max-ratio 3]
+#
+# Each pattern is repeated up to every size, with no input limits: the cost
+# per character must stay flat. Exits with status 1 if, for some pattern, the
+# largest input costs more than --max-ratio times per character the smallest.
+import sys, os, time, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from w32lex import *
+
+NO_LIMITS = Limits(None)
+ENV = Environment({'X': 'value', 'Y': 'a,b'})
+
+def grow(unit, size, head='', tail=''):
+    "Repeat unit up to size chars, between head and tail"
+    return head + unit * max(1, (size-len(head)-len(tail)) // len(unit)) + tail
+
+PATTERNS = [
+    ('split', 'quotes', lambda n: grow('"', n, 'a ')),
+    ('split', 'escaped quotes', lambda n: grow('\\"', n, 'a "')),
+    ('split', 'backslashes', lambda n: grow('\\', n, 'a "', '"')),
+    ('split', 'backslash runs', lambda n: grow('\\\\\\ "', n, 'a ')),
+    ('split', 'blanks', lambda n: grow(' \t', n, 'a', 'b')),
+    ('split', 'quoted blanks', lambda n: grow(' ', n, 'a "', '"')),
+    ('cmd_parse', 'nesting', lambda n: grow('(', n//2, '', 'a') + ')' * (n//2 - 1)),
+    ('cmd_parse', 'echo off', lambda n: grow('@', n, '', 'a')),
+    ('cmd_parse', 'variables', lambda n: grow('%X%%Y:a=bc%', n, 'echo ')),
+    ('cmd_parse', 'carets', lambda n: grow('^^^', n, 'a ')),
+    ('cmd_parse', 'slashes', lambda n: grow('/a', n, 'a ')),
+    ('cmd_parse', 'operators', lambda n: grow('a|b&&c||d>e 2>&1&', n)),
+    ('cmd_parse', 'quoted operators', lambda n: grow('|&<>()', n, 'a "', '"')),
+]
+
+def cost(func, s, budget=0.2):
+    "Return the best time per character of func(s), in ns"
+    best = None
+    total = 0
+    while total < budget or best is None:
+        t = time.perf_counter()
+        func(s)
+        t = time.perf_counter() - t
+        total += t
+        if best is None or t < best: best = t
+    return best / len(s) * 1e9
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='w32lex adversarial inputs benchmark')
+    ap.add_argument('--max-size', type=int, default=1<<20, help='largest input (default 1 MB)')
+    ap.add_argument('--max-ratio', type=float, default=3.0, help='tolerated growth of the cost per character (default 3)')
+    opts = ap.parse_args(argv)
+
+    funcs = {'split': lambda s: split(s, limits=NO_LIMITS),
+             'cmd_parse': lambda s: cmd_parse(s, CMD_VAREXPAND, ENV, NO_LIMITS)}
+    sizes = []
+    size = 1024
+    while size <= opts.max_size:
+        sizes += [size]
+        size *= 4
+    print('%-28s' % 'ns/char' + ''.join(['%10s' % ('%dK' % (size>>10)) for size in sizes]))
+    failed = []
+    for func, name, make in PATTERNS:
+        costs = [cost(funcs[func], make(size)) for size in sizes]
+        label = '%s/%s' % (func, name)
+        flag = ''
+        if costs[-1] > opts.max_ratio * costs[0]:
+            failed += [label]
+            flag = ' FAIL'
+        print('%-28s' % label + ''.join(['%10.1f' % c for c in costs]) + flag)
+    if failed:
+        print('superlinear: ' + ', '.join(failed))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,20 @@
+# quote / join throughput on plain and quoting-needing argument lists
+import sys, timeit
+sys.path.insert(0, '.')
+from w32lex import *
+
+PLAIN = [r'C:\Windows\System32\svchost.exe', '-k', 'netsvcs', '/c', '-NoProfile', r'C:\Temp\x.log']
+MIXED = PLAIN + [r'C:\Program Files\App', 'say "hi"', '', 'tail\\']
+
+def bench(name, func, arg, number):
+    t = min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+    print('%-28s %10.2f us' % (name, t*1e6))
+
+if __name__ == '__main__':
+    for size in (1, 10, 1000):
+        for kind, items in (('plain', PLAIN), ('mixed', MIXED)):
+            argv = (items * (size//len(items) + 1))[:size]
+            bench('join %4d %s args' % (size, kind), join, argv, 20000//size + 10)
+    bench('quote plain', quote, PLAIN[0], 100000)
+    bench('quote blanks', quote, MIXED[-4], 100000)
+    bench('quote quotes', quote, MIXED[-3], 100000)
@@ -0,0 +1,28 @@
+# Scaling of split_many / cmd_split_many across executors and pool sizes
+import sys, time, random
+sys.path.insert(0, '.')
+from w32lex import *
+
+def corpus(count, seed=0):
+    "Process creation like command lines"
+    r = random.Random(seed)
+    exes = [r'C:\Windows\System32\svchost.exe', r'"C:\Program Files\Common Files\app.exe"',
+            r'C:\Windows\system32\cmd.exe', r'powershell.exe']
+    opts = ['-k netsvcs', '-p', '/c', '-NoProfile', r'"C:\Users\John Doe\file.txt"',
+            r'-s "a \"quoted\" value"', '/d', r'C:\Temp\x.log', '--flag=1']
+    return [' '.join([r.choice(exes)] + r.sample(opts, r.randint(2, 8))) for i in range(count)]
+
+def run(name, func, lines, **kw):
+    t = time.perf_counter()
+    n = sum(1 for argv in func(lines, **kw))
+    t = time.perf_counter() - t
+    assert n == len(lines)
+    print('%-16s %-8s %2s workers: %9.0f lines/s' % (func.__name__, name, kw.get('workers', 1), len(lines)/t))
+
+if __name__ == '__main__':
+    lines = corpus(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+    for func in (split_many, cmd_split_many):
+        run(INLINE, func, lines)
+        for executor in (THREAD, PROCESS):
+            for workers in (1, 2, 4, 8):
+                run(executor, func, lines, executor=executor, workers=workers, chunksize=4096)
@@ -0,0 +1,164 @@
+# Throughput and memory benchmarks over reproducible synthetic corpora
+#
+#   python bench/bench_suite.py [--quick] [--save FILE] [--baseline FILE] [--max-regression 0.2]
+#
+# Reports chars/s and peak allocation of split (every mode), quote/join,
+# cmd_parse and cmd_split, compared with shlex and mslex (when installed).
+# With --baseline, exits with status 1 if any benchmark is slower than the
+# saved figure by more than --max-regression (a fraction).
+import sys, os, time, json, random, shlex, tracemalloc, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from w32lex import *
+
+try:
+    import mslex
+except ImportError:
+    mslex = None
+
+
+def mslex_cases():
+    "The mslex test cases of test_suite.py"
+    from test_suite import cases
+    return [case[0] for case in cases]
+
+def process_lines(count, seed=0):
+    "Realistic process creation command lines"
+    r = random.Random(seed)
+    exes = [r'C:\Windows\System32\svchost.exe', r'"C:\Program Files\Common Files\Microsoft Shared\app.exe"',
+            r'C:\Windows\system32\cmd.exe', 'powershell.exe', r'"C:\Program Files (x86)\Google\Chrome\Application\chrome.exe"',
+            r'C:\Windows\System32\rundll32.exe', 'conhost.exe']
+    opts = ['-k netsvcs', '-p', '-s Schedule', '/c', '-NoProfile', '-ExecutionPolicy Bypass', '0xffffffff',
+            r'"C:\Users\John Doe\AppData\Local\Temp\setup.log"', r'--type=renderer --field-trial-handle=1234,i,567',
+            r'-Command "Get-Process | Where-Object {$_.CPU -gt 100}"', r'C:\Windows\System32\shell32.dll,Control_RunDLL',
+            r'--user-data-dir="C:\Users\John Doe\AppData\Local\Google\Chrome\User Data"', '/d', '/s', '-Embedding']
+    return [' '.join([r.choice(exes)] + r.sample(opts, r.randint(1, 7))) for i in range(count)]
+
+def pathological_lines(count, seed=0):
+    "Long runs of quotes and backslashes"
+    r = random.Random(seed)
+    return [''.join(r.choice(['"' * r.randint(1, 40), '\\' * r.randint(1, 40), 'a', ' ']) for j in range(60)) for i in range(count)]
+
+def dense_lines(count, seed=0):
+    "Short quoted arguments and escaped quotes, and a run of quotes: split char by char"
+    r = random.Random(seed)
+    pieces = ['"a"', '"b c"', '\\"', '""', '"\\\\"', 'x']
+    return [' '.join([r.choice(pieces) for j in range(400)]) for i in range(count)] + ['"' * 4000]
+
+def nested_lines(count, depth=200):
+    "Deeply nested CMD parentheses"
+    return ['%s echo %d %s' % ('(' * (depth+i), i, ')' * (depth+i)) for i in range(count)]
+
+def long_lines(count, seed=0):
+    "Lines near the CreateProcess limit"
+    base = process_lines(2000, seed)
+    lines = []
+    for i in range(count):
+        line = base[i]
+        while len(line) < MAX_CMDLINE - 400:
+            line += ' ' + base[(i + len(line)) % len(base)]
+        lines.append(line[:MAX_CMDLINE-1])
+    return lines
+
+def argv_lists(count, seed=0):
+    "Argument lists to quote and join"
+    return [split(line) for line in process_lines(count, seed)]
+
+
+def measure(func, items, size, repeat):
+    "Return best chars/s of func over items (size chars) and peak allocation"
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        for item in items:
+            func(item)
+        t = time.perf_counter() - t
+        if best is None or t < best: best = t
+    tracemalloc.start()
+    for item in items:
+        func(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size / best, peak
+
+def tolerant(func):
+    "Wrap a third party splitter, ignoring inputs it rejects"
+    def wrapper(s):
+        try:
+            return func(s)
+        except ValueError:
+            return None
+    return wrapper
+
+def benchmarks(quick):
+    n = 200 if quick else 2000
+    corpora = {
+        'mslex': mslex_cases(),
+        'process': process_lines(n),
+        'pathological': pathological_lines(n // 10),
+        'dense': dense_lines(n // 20),
+        'long': long_lines(2 if quick else 10),
+    }
+    cmd_corpora = {
+        'process': corpora['process'],
+        'nested': nested_lines(n // 20),
+    }
+    env = Environment()
+    for name, lines in corpora.items():
+        for mode, label in ((SPLIT_SHELL32, 'shell32'), (SPLIT_ARGV0, 'argv0'), (SPLIT_VC2005, 'vc2005')):
+            yield 'split/%s/%s' % (label, name), lambda s, mode=mode: split(s, mode), lines
+        yield 'shlex/%s' % name, tolerant(shlex.split), lines
+        if mslex:
+            yield 'mslex/%s' % name, tolerant(lambda s: mslex.split(s, like_cmd=False)), lines
+    for name, lines in cmd_corpora.items():
+        yield 'cmd_parse/%s' % name, lambda s: cmd_parse(s, env=env), lines
+        yield 'cmd_split/%s' % name, lambda s: cmd_split(s, env=env), lines
+    args = argv_lists(n)
+    yield 'quote/process', quote, [arg for argv in args for arg in argv]
+    yield 'join/process', join, args
+    yield 'shlex.join/process', shlex.join, args
+    if mslex:
+        yield 'mslex.join/process', mslex.join, args
+
+def size_of(items):
+    if items and type(items[0]) == list:
+        return sum(map(len, map(''.join, items)))
+    return sum(map(len, items))
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='w32lex throughput and memory benchmarks')
+    ap.add_argument('--quick', action='store_true', help='smaller corpora, single run')
+    ap.add_argument('--save', help='save results to a JSON file')
+    ap.add_argument('--baseline', help='compare against results saved in a JSON file')
+    ap.add_argument('--max-regression', type=float, default=0.2, help='tolerated slowdown against baseline (default 0.2)')
+    ap.add_argument('--filter', default='', help='run only benchmarks whose name contains this')
+    opts = ap.parse_args(argv)
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+    results = {}
+    failed = []
+    print('%-32s %14s %12s %10s' % ('benchmark', 'chars/s', 'peak KiB', 'vs base'))
+    for name, func, items in benchmarks(opts.quick):
+        if opts.filter not in name: continue
+        rate, peak = measure(func, items, size_of(items), 1 if opts.quick else 3)
+        results[name] = {'chars_per_sec': rate, 'peak_bytes': peak}
+        change = ''
+        if name in baseline:
+            ratio = rate / baseline[name]['chars_per_sec']
+            change = '%+.0f%%' % ((ratio-1) * 100)
+            if ratio < 1 - opts.max_regression:
+                failed += [name]
+                change += ' FAIL'
+        print('%-32s %14.0f %12.1f %10s' % (name, rate, peak/1024, change))
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if failed:
+        print('regressions over %.0f%%: %s' % (opts.max_regression*100, ', '.join(failed)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,7 @@
-import unittest, sys
+import unittest, sys, os
+from importlib.util import find_spec
 from w32lex import *
+from w32lex.columnar import _rows
 
 # from https://github.com/smoofra/mslex
 cases = [
@@ -251,6 +253,83 @@ cases = [
 ]
 
 
+def ref_split(s, mode=SPLIT_SHELL32):
+    "Original per-character split, reference for the faster engines"
+    argv = []
+    arg = ''
+    quoted = backslashes = quotes = space = 0
+    if not s: return []
+    if mode&1:
+        i=0
+        for c in s:
+            i += 1
+            if c == '"':
+                if quoted: break
+                if i == 1:
+                    quoted = not quoted
+                    continue
+            if c in ' \t':
+                if quoted:
+                    arg += c
+                    continue
+                break
+            arg += c
+        argv += [arg]
+        arg=''
+        quoted = 0
+        s = s[i:]
+    s = s.strip()
+    if not s: return argv
+    for c in s:
+        if c == '\\':
+            space = 0
+            backslashes += 1
+            continue
+        if c == '"':
+            space = 0
+            if backslashes:
+                arg += '\\' * (backslashes//2)
+                if backslashes%2:
+                    arg += c
+                    backslashes = 0
+                    continue
+                backslashes = 0
+            quoted = not quoted
+            quotes += 1
+            if quotes == 3 or quotes == 2 and quoted:
+                arg += c
+                quoted = not quoted
+                if mode&2:
+                    quoted = not quoted
+                quotes = 0
+            continue
+        if backslashes:
+            arg += '\\' * backslashes
+        quotes = backslashes = 0
+        if c in ' \t':
+            if quoted:
+                arg += c
+                continue
+            if not space:
+                argv += [arg]
+                arg = ''
+            space += 1
+            continue
+        space = 0
+        arg += c
+    if backslashes:
+        arg += '\\' * backslashes
+    argv += [arg]
+    return argv
+
+def random_lines(count, seed=0, length=16):
+    "Random command lines stressing quotes, backslashes and blanks"
+    import random
+    r = random.Random(seed)
+    alphabet = ['a', 'b', ' ', '\t', '"', '\\', '\n', 'x y', '""', '\\"']
+    return [''.join(r.choice(alphabet) for i in range(r.randint(0, length))) for j in range(count)]
+
+
 if os.name == 'nt':
     from ctypes import *
     from ctypes import windll, wintypes
@@ -350,8 +429,489 @@ class w32lex(unittest.TestCase):
 
 
 
+class portable(unittest.TestCase):
+    "Tests not requiring Windows"
+    def test_split_engine(p):
+        "Test split against the reference parser"
+        for s in [case[0] for case in cases] + random_lines(20000):
+            for mode in (SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005, SPLIT_ARGV0|SPLIT_VC2005):
+                p.assertEqual(split(s, mode), ref_split(s, mode), 'split differs from reference: '+repr(s))
+        # lines dense in quotes are split char by char, the others run by run: force each way
+        import w32lex
+        dense = w32lex._DENSE
+        try:
+            for w32lex._DENSE in (0, 1 << 30):
+                for s in random_lines(2000):
+                    for mode in (SPLIT_SHELL32, SPLIT_VC2005, SPLIT_ARGV0|SPLIT_VC98):
+                        p.assertEqual(split(s, mode), ref_split(s, mode) if mode != SPLIT_ARGV0|SPLIT_VC98
+                                      else list(split_spans(s, mode)), 'scanners differ: '+repr(s))
+        finally:
+            w32lex._DENSE = dense
+
+    def test_vc98(p):
+        "Test the STDARGV98.C dialect"
+        mode = SPLIT_ARGV0|SPLIT_VC98
+        p.assertEqual(split('a "b ', mode), ['a', 'b '])
+        p.assertEqual(split(r'x ""\\"y z', mode), ['x', '\\y z'])
+        p.assertEqual(split(r'x "\""" y', mode), ['x', '""', 'y'])
+        p.assertEqual(split('x "a""b" c', mode), ['x', 'a"b c'])
+        for s in random_lines(2000):
+            p.assertEqual(list(split_spans(s, mode)), split(s, mode))
+            p.assertEqual(list(W32Lexer(s, mode, 3)), split(s, mode))
+        p.assertRaises(ValueError, split, 'a', SPLIT_VC2005|SPLIT_VC98)
+
+
+    def test_bytes(p):
+        "Test bytes-like command lines in single and double byte codepages"
+        for cp in ('cp1252', 'utf-8', 'cp932'):
+            for s in [case[0] for case in cases] + random_lines(1000) + ['\u8868\\"a b" \u30bd\\']:
+                b = s.encode(cp, 'replace')
+                argv = [arg.encode(cp) for arg in split(b.decode(cp))]
+                for mode in (SPLIT_SHELL32, SPLIT_ARGV0|SPLIT_VC2005):
+                    p.assertEqual(split(memoryview(b), mode, cp), [arg.encode(cp) for arg in split(b.decode(cp), mode)])
+                if '\n' not in s: # quote leaves newlines, which split strips, alone
+                    p.assertEqual(split(join(argv, cp), codepage=cp), argv)
+        # 0x5C is the trail byte of U+8868 in cp932
+        p.assertEqual(quote('\u8868 x'.encode('cp932'), 'cp932'), '"\u8868 x"'.encode('cp932'))
+        p.assertEqual((quote(bytearray(b'a b')), quote(memoryview(b'x'))), (b'"a b"', b'x'))
+        # only str and bytes-like objects are quoted or split
+        for func, arg in ((quote, 5), (join, [1, 2]), (join, [b'a', 3]), (split, [b'a'])):
+            p.assertRaises(TypeError, func, arg)
+
+    def test_split_many(p):
+        "Test batch splitting on every executor"
+        lines = [case[0] for case in cases] + random_lines(2000)
+        for executor in (INLINE, THREAD, PROCESS):
+            for mode in (SPLIT_SHELL32, SPLIT_ARGV0|SPLIT_VC2005):
+                p.assertEqual(list(split_many(lines, mode, executor, 2, 100)), [split(s, mode) for s in lines])
+        lines = ['a|b', '(a b) & c >d', 'a 2>&1']
+        p.assertEqual(list(cmd_split_many(lines, executor=PROCESS, chunksize=2)), [cmd_split(s) for s in lines])
+        p.assertRaises(NotExpected, list, cmd_split_many(['a', '|b'], executor=PROCESS))
+        # an Executor with no pool size
+        from concurrent.futures import Executor, Future
+        class Inline(Executor):
+            def submit(p, func, *args):
+                future = Future()
+                future.set_result(func(*args))
+                return future
+        p.assertEqual(list(split_many(lines, executor=Inline(), chunksize=1)), [split(s) for s in lines])
+
+    def test_cli(p):
+        "Test python -m w32lex on a file sharded in many ranges"
+        import json, tempfile
+        from w32lex.__main__ import main
+        lines = [case[0] for case in cases] + random_lines(2000)
+        lines = [s.replace('\n', ' ').replace('\r', ' ') for s in lines]
+        with tempfile.TemporaryDirectory() as tmp:
+            src, dst = os.path.join(tmp, 'in.txt'), os.path.join(tmp, 'out.jsonl')
+            with open(src, 'w', encoding='utf-8', newline='') as f:
+                f.write('\n'.join(lines) + '\n')
+            p.assertEqual(main(['split', src, '-o', dst, '--mode', 'argv0,vc2005', '--workers', '2', '--chunk-size', '4096']), 0)
+            with open(dst, encoding='utf-8') as f:
+                p.assertEqual([json.loads(line) for line in f], [split(s, SPLIT_ARGV0|SPLIT_VC2005) for s in lines])
+            with open(src, 'w', encoding='utf-8') as f:
+                f.write('{"cmd": "a \\"b c\\""}\n\n{"cmd": "d"}\n')
+            p.assertEqual(main(['split', src, '-o', dst, '--field', 'cmd', '--nul']), 0)
+            with open(dst, 'rb') as f:
+                p.assertEqual(f.read(), b'a\0b c\0\nd\0\n')
+            # bad records are written as null and counted
+            import io, contextlib
+            with open(src, 'w', encoding='utf-8') as f:
+                f.write('["a b", "c"]\n[1]\n{"a": 1}\n"x"\n["d"]\n')
+            err = io.StringIO()
+            with contextlib.redirect_stderr(err):
+                p.assertEqual(main(['join', src, '-o', dst]), 1)
+            p.assertIn('3 records failed, first with TypeError', err.getvalue())
+            with open(dst, encoding='utf-8') as f:
+                p.assertEqual([json.loads(line) for line in f], ['"a b" c', None, None, None, 'd'])
+
+    def test_cache(p):
+        "Test LRU memoization and stale expansions"
+        c = SplitCache(2)
+        for s in ('a "b c"', 'a "b c"', 'd e', 'f'):
+            p.assertEqual(c.split(s), split(s))
+        p.assertEqual(c.cache_info(), (1, 3, 2, 2))
+        p.assertEqual(c.split('a "b c"'), split('a "b c"')) # evicted
+        p.assertEqual(c.cache_info().misses, 4)
+        p.assertEqual(c.quote('a b'), c.quote('a b'))
+        env = {'FOO': 'x'}
+        p.assertEqual(c.cmd_split('a %FOO%', env=env), ['a', 'x'])
+        p.assertEqual(c.cmd_split('a %FOO%', env=env), ['a', 'x'])
+        env['FOO'] = 'y'
+        p.assertEqual(c.cmd_split('a %FOO%', env=env), ['a', 'y'])
+        c.cache_clear()
+        p.assertEqual(c.cache_info(), (0, 0, 2, 0))
+
+    def test_lexer(p):
+        "Test streaming lexer against split, with any chunk size"
+        import io
+        for s in [case[0] for case in cases] + random_lines(3000, 1, 30):
+            for mode in (SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005):
+                for chunksize in (1, 3, 64):
+                    p.assertEqual(list(W32Lexer(io.StringIO(s), mode, chunksize)), split(s, mode), 'W32Lexer differs from split: '+repr(s))
+        lex = W32Lexer('a "b c" d')
+        p.assertEqual(lex.get_token(), 'a')
+        lex.push_token('x')
+        p.assertEqual(list(lex), ['x', 'b c', 'd'])
+        p.assertEqual(lex.get_token(), lex.eof)
+
+    def test_spans(p):
+        "Test argument offsets against split"
+        for s in [case[0] for case in cases] + random_lines(10000, 2):
+            for mode in (SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005):
+                spans = split_spans(s, mode)
+                p.assertEqual(list(spans), split(s, mode), 'split_spans differs from split: '+repr(s))
+                for i in range(len(spans)):
+                    start, end = spans.span(i)
+                    if not spans.flags[i]:
+                        p.assertEqual(s[start:end], spans[i])
+        spans = split_spans('"a b" c\\d "e"', SPLIT_ARGV0)
+        p.assertEqual(list(spans.offsets), [1, 4, 6, 9, 10, 13])
+        p.assertEqual(list(spans.flags), [0, 0, 1])
+
+    def test_join(p):
+        "Test quoting round trip and plain arguments"
+        # quote encloses in quotes blanks only
+        args = [arg.replace('\n', 'n') for arg in random_lines(4000, 3, 6)]
+        for i in range(0, len(args), 5):
+            argv = args[i:i+1+i%5]
+            for arg in argv: p.assertEqual(split(quote(arg)), [arg], 'failed quoting: '+repr(arg))
+            p.assertEqual(split(join(argv)), argv, 'failed joining: '+repr(argv))
+        for arg in ('C:\\Windows\\x.exe', '/c', '-k', 'a\\'):
+            p.assertEqual(quote(arg), arg)
+        p.assertEqual(join(iter(['a', '', 'b c'])), 'a "" "b c"')
+
+    def test_cmd_tree(p):
+        "Test typed CMD tree"
+        for s in ('a b', '@a b|c', '(a b) && c', 'a 2>&1 >x.log', 'a b>c&d||e', '((a b c))',
+                  '(a 2>b 1>&2 c)', 'a/b c', 'a "b c" ^& d', 'dir 1>^&2', '(a) (b)', 'a|&2 & b', 'a &'):
+            tree = cmd_tree(s)
+            p.assertEqual(tree.tokens(), cmd_parse(s))
+            p.assertEqual(cmd_split(tree), cmd_split(s))
+        tree = cmd_tree('@(a & b | c) > "out file" 2>&1 && d <in')
+        p.assertTrue(tree.echo_off)
+        cond = tree.items[0]
+        p.assertEqual(cond.op, '&&')
+        p.assertEqual(cond.right.argv, ['d'])
+        p.assertEqual([(r.handle, r.op, r.target) for r in cond.left.redirects], [(None, '>', 'out file'), (2, '>&', '1')])
+        p.assertEqual([n.argv for n in cond.left.body.items[1].commands], [['b'], ['c']])
+        p.assertEqual([r.target for n in tree.walk() if isinstance(n, Command) for r in n.redirects], ['out file', '1', 'in'])
+
+    def test_cmd_dialects(p):
+        "Test CMD dialects"
+        p.assertEqual(cmd_parse(' ;,a  b'), ['a  b'])
+        p.assertEqual(cmd_parse('2>nul dir'), ['2>', 'nul dir'])
+        p.assertEqual(cmd_parse('^;a'), [';', 'a'])
+        p.assertEqual(cmd_parse('^;a', CMD_NT), [])
+        p.assertRaises(NotExpected, cmd_parse, ':a', CMD_NT)
+        p.assertEqual(cmd_parse(';,a', CMD_COMMAND), [',a'])
+        p.assertEqual(cmd_parse('a ^&& (b|c) 2>&1', CMD_COMMAND), ['a ^&& (b', '|', 'c) 2', '>', '&1'])
+        p.assertRaises(NotExpected, cmd_parse, '@a', CMD_COMMAND)
+        p.assertRaises(ValueError, cmd_parse, 'a', CMD_NT|CMD_COMMAND)
+
+    def test_limits(p):
+        "Test input budgets and deep nesting"
+        p.assertRaises(LimitExceeded, split, 'a' * (MAX_CMDLINE+1), limits=Limits())
+        p.assertRaises(LimitExceeded, cmd_parse, 'a' * (MAX_CMDLINE+1), limits=Limits())
+        p.assertEqual(len(split('a ' * 20000)), 20000) # no limits, by default
+        p.assertEqual(len(split_spans('a ' * 20000)), 20000)
+        p.assertEqual(len(cmd_split('a ' * 20000)), 20000)
+        p.assertRaises(LimitExceeded, split, 'a b c', limits=Limits(tokens=2))
+        p.assertRaises(LimitExceeded, cmd_parse, '((a))', limits=Limits(depth=1))
+        p.assertRaises(LimitExceeded, cmd_parse, '%X%%X%', env={'X': 'x'*20}, limits=Limits(length=30))
+        p.assertEqual(cmd_parse('@@@'), ['@'])
+        s = '(' * 50000 + 'a' + ')' * 50000
+        p.assertEqual(cmd_parse(s, limits=Limits(None)), [s])
+        p.assertEqual(cmd_tree(s, limits=Limits(None)).tokens(), [s])
+
+    def test_expand(p):
+        "Test variables expansion from an Environment snapshot"
+        env = Environment({'Path': 'C:\\Windows;C:\\Tools', 'X': 'Hello World'})
+        for s, argv in (('a %path% b', ['a', 'C:\\Windows;C:\\Tools', 'b']), ('%X:~0,5%', ['Hello']),
+                        ('%X:~-5%', ['World']), ('%X:~2,-2%', ['llo', 'Wor']), ('%X:o=0%', ['Hell0', 'W0rld']),
+                        ('%X:*l=%', ['lo', 'World']), ('%X:WORLD=there%', ['Hello', 'there']), ('%%X%%', ['%Hello', 'World%']),
+                        ('^%X^% %X%', ['%X%', 'Hello', 'World']), ('%X^%', ['%X%']), ('%UNDEF% "%X%"', ['%UNDEF%', 'Hello World']),
+                        ('% %X%', ['%', 'Hello', 'World']), ('%X:~a%', ['%X:~a%']),
+                        # empty substrings and substitutions expand to nothing
+                        ('a%X:~20%b', ['ab']), ('a%X:~0,0%b', ['ab']), ('a%X:hello world=%b', ['ab']), ('a%X:*d=%b', ['ab'])):
+            p.assertEqual(cmd_split(s, env=env), argv)
+            p.assertEqual(IncrementalCmdSplit(s, env=env).argv, argv)
+        p.assertEqual(cmd_split('!x! %x% !y!', SPLIT_SHELL32|CMD_VAREXPAND|CMD_EXCLMARK, env=env), ['Hello', 'World', 'Hello', 'World', '!y!'])
+        p.assertEqual(list(cmd_split_many(['%X%'], executor=PROCESS, env=env)), [['Hello', 'World']])
+
+    def test_batfile(p):
+        "Test the streaming batch file parser"
+        src = ('@echo off\r\nsetlocal EnableDelayedExpansion\r\n:Start\r\nrem (comment\r\nset x=1 ^\r\n& echo !x!\r\n'
+               'if 1==1 (\r\n  echo a\r\n\r\n  echo b\r\n) else (\r\n  echo c)\r\n:: note\r\nendlocal\r\necho !x! ) &\r\ngoto :start\r\n')
+        bat = BatchFile(src, env=Environment({'x': '1'}))
+        lines = list(bat)
+        p.assertEqual([l.lineno for l in lines], [1, 2, 3, 4, 5, 7, 13, 14, 15, 16])
+        p.assertEqual(lines[0].tokens, ['@', 'echo off'])
+        p.assertEqual((lines[2].label, lines[3].tokens), ('start', ['rem (comment']))
+        p.assertEqual(lines[4].tokens, ['set x=1 & echo 1'])
+        p.assertEqual(lines[5].tokens, ['if 1==1 ', '(   echo a &   echo b )', ' else ', '(   echo c)'])
+        p.assertIsInstance(lines[8].error, NotExpected)
+        p.assertEqual(bat.label(':START'), (3, lines[2].offset))
+        p.assertEqual(src[lines[2].offset:].split('\r')[0], ':Start')
+
+    def test_join_chunks(p):
+        "Test packing arguments into the fewest command lines under a length"
+        argv = ['file %d.txt' % i for i in range(100)] + ['', 'a"b\\', 'c:\\x y\\']
+        prefix = ['C:\\Program Files\\tool.exe', '/q']
+        lines = list(join_chunks(argv, 120, prefix))
+        p.assertTrue(all(len(line) <= 120 for line in lines))
+        p.assertEqual(sum([split(line)[2:] for line in lines], []), argv)
+        p.assertTrue(all(split(line)[:2] == prefix for line in lines))
+        # greedy: the first argument of a line did not fit in the one before
+        for line, after in zip(lines, lines[1:]):
+            p.assertTrue(len(line) + 1 + len(quote(split(after)[2])) > 120)
+        lines = list(join_chunks(['a b', 'c&d', '100%'] * 50, 60, cmd=1))
+        p.assertEqual(sum([cmd_split(line) for line in lines], []), ['a b', 'c&d', '100%'] * 50)
+        # blanks with operators, and embedded quotes, never leak into the next arguments
+        argv = ['p q&r', '"q"', 'a "b', 'x y|(z)', '%PATH%', '@a/b', '', 'c:\\x y\\']
+        lines = list(join_chunks(argv * 20, 80, ['C:/tools/t.exe', '/q'], cmd=1))
+        p.assertEqual(sum([cmd_split(line)[2:] for line in lines], []), argv * 20)
+        p.assertTrue(all(cmd_split(line)[:2] == ['C:/tools/t.exe', '/q'] for line in lines))
+        p.assertEqual(cmd_split(' '.join(map(cmd_quote, argv))), argv)
+        p.assertRaises(ValueError, cmd_quote, 'a\r')
+        p.assertEqual(list(join_chunks([], 10)), [])
+        p.assertRaises(LimitExceeded, list, join_chunks(['x' * 20], 20, ['a']))
+
+    def test_metrics(p):
+        "Test the opt-in instrumentation of split and cmd_parse"
+        env = Environment({'X': 'a b'})
+        lines = ['a"""b c', 'x\\\\"y z"', 'p\\"q', '(echo %x%%x:~9%) & y', 'echo )']
+        def run():
+            out = [split(line) for line in lines]
+            for line in lines:
+                try:
+                    out += [cmd_parse(line, env=env)]
+                except NotExpected as e:
+                    out += [e.token]
+            return out
+        expected = run()
+        events = []
+        reset_stats()
+        instrument(trace=lambda *event: events.append(event))
+        try:
+            p.assertEqual(run(), expected)
+        finally:
+            instrument(False)
+        s = stats()
+        p.assertEqual((s['split']['calls'], s['split']['args']), (5, sum(map(len, expected[:5]))))
+        p.assertEqual((s['cmd_parse']['calls'], s['cmd_parse']['errors'], s['cmd_parse']['expansions']), (5, 1, 2))
+        p.assertEqual((s['split']['rules']['triple'], s['split']['rules']['escaped'], s['split']['rules']['slashes']), (1, 1, 1))
+        p.assertEqual((s['cmd_parse']['rules']['open'], s['cmd_parse']['rules']['close']), (1, 2))
+        p.assertIn(('cmd_parse', 'expansion', 'x:~9'), events)
+        p.assertEqual(len(events), sum(s['split']['rules'].values()) + sum(s['cmd_parse']['rules'].values()) + 2)
+        # off: counters stay still
+        run()
+        p.assertEqual(stats(), s)
+        reset_stats()
+        p.assertEqual(stats()['split']['calls'], 0)
+
+    def test_split_array(p):
+        "Test the columnar split into Arrow-style buffers"
+        rows = [case[0] for case in cases] + ['', None, ' a\tb\\ ', 'caf\xe9 "x y"']
+        for mode in (SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005):
+            sa = split_array(rows, mode)
+            p.assertEqual([sa[i] for i in range(len(sa))], [split(s or '', mode) for s in rows])
+        p.assertEqual((sa.offsets.typecode, sa.row_offsets[-1]), ('i', len(sa.offsets)-1))
+        p.assertEqual(sa.values[sa.offsets[-3]:], 'café'.encode() + b'x y')
+
+    @unittest.skipUnless(find_spec('numpy') and find_spec('pandas'), 'NumPy and pandas are needed')
+    def test_split_array_numpy(p):
+        "Test the columnar split of NumPy arrays and pandas Series"
+        import numpy, pandas
+        rows = [case[0] for case in cases] + ['', None, 3, 'caf\xe9 "x y"']
+        strs = [case[0] for case in cases] + ['', 'caf\xe9 "x y"']
+        for arr in (numpy.array(strs), numpy.array(rows, dtype=object), pandas.Series(rows),
+                    pandas.Series(strs, dtype='string'), pandas.Series([1, 2])):
+            sa = split_array(arr)
+            p.assertEqual([sa[i] for i in range(len(sa))], [split(s if type(s) is str else '') for s in _rows(arr)])
+
+    @unittest.skipUnless(find_spec('pyarrow'), 'pyarrow is needed')
+    def test_split_array_arrow(p):
+        "Test the columnar split of pyarrow arrays, and its conversion to them"
+        import pyarrow
+        from array import array
+        rows = [case[0] for case in cases] + ['', None, 'caf\xe9 "x y"']
+        for arr in (pyarrow.array(rows), pyarrow.array(rows, pyarrow.large_string()),
+                    pyarrow.chunked_array([rows[:10], rows[10:]])):
+            sa = split_array(arr)
+            p.assertEqual(sa.to_arrow().to_pylist(), [split(s or '') for s in rows])
+        large = SplitArray(sa.values, array('q', sa.offsets), sa.row_offsets)
+        p.assertEqual(large.to_arrow().type, pyarrow.large_list(pyarrow.large_string()))
+        p.assertEqual(large.to_arrow().to_pylist(), sa.to_arrow().to_pylist())
+
+    def test_async(p):
+        "Test the asyncio streaming split"
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        lines = [case[0] for case in cases]
+        async def source():
+            for i, line in enumerate(lines):
+                if i % 10 == 0: await asyncio.sleep(0)
+                yield line
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data('\r\n'.join(lines).encode() + b'\r\n')
+            reader.feed_eof()
+            p.assertEqual([argv async for argv in split_async(reader, budget=100)], [split(s) for s in lines])
+            with ThreadPoolExecutor(2) as executor:
+                result = [argv async for argv in split_async(source(), SPLIT_VC2005, executor, 200)]
+            p.assertEqual(result, [split(s, SPLIT_VC2005) for s in lines])
+            env = Environment({'X': 'a b'})
+            p.assertEqual([argv async for argv in cmd_split_async(source(), env=env)], [cmd_split(s, env=env) for s in lines])
+        asyncio.run(run())
+        p.assertRaises(ValueError, split_async, source(), executor='fork')
+
+    def test_argv_table(p):
+        "Test the dictionary-encoded store of argument lists"
+        import pickle
+        rows = [split(case[0]) for case in cases] * 3
+        table = ArgvTable(rows)
+        table.append_line('/c "a b" /c')
+        table.append_cmd_line('echo %X% /c', env=Environment({'X': 'x y'}))
+        rows += [['/c', 'a b', '/c'], ['echo', 'x', 'y', '/c']]
+        p.assertEqual(len(table), len(rows))
+        p.assertEqual([table[i] for i in range(len(rows))], rows)
+        p.assertEqual(table[-1][1:3], ['x', 'y'])
+        p.assertEqual(table[-2].tolist(), rows[-2])
+        p.assertEqual(table.unique(), len(set(arg for argv in rows for arg in argv)))
+        copy = pickle.loads(pickle.dumps(table))
+        p.assertEqual([list(argv) for argv in copy], rows)
+        copy.append(iter(['/c', 'new']))
+        p.assertEqual((copy[-1], copy.unique()), (['/c', 'new'], table.unique()+1))
+
+    def test_incremental(p):
+        "Test the incremental split of an edited line against split"
+        import random
+        r = random.Random(21)
+        for mode in (SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005, SPLIT_VC98):
+            inc = IncrementalSplit('', mode)
+            for k in range(300):
+                line = inc.line
+                i = r.randint(0, len(line))
+                j = r.randint(i, min(len(line), i+3))
+                text = ''.join(r.choice('ab  "\\\t\n') for c in range(r.randint(0, 3)))
+                if k % 2:
+                    argv = inc.edit(i, j, text)
+                else:
+                    argv = inc.update(line[:i] + text + line[j:])
+                p.assertEqual(inc.line, line[:i] + text + line[j:])
+                p.assertEqual(argv, split(inc.line, mode))
+
+    def test_incremental_cmd(p):
+        "Test the incremental cmd_split of an edited line against cmd_split"
+        import random
+        r = random.Random(21)
+        env = {'X': 'a b', 'Y': '&(', 'Z': 'q"r'}
+        chunks = ['a', ' ', ' ', '"', '^', '&', '|', '(', ')', '<', '>', '1', '2>&1', '/', '\\',
+                  '%', '%X%', '%Y%', '%Z%', '%X:~0,1%', '!X!', ':', '@', ',']
+        for mode in (SPLIT_SHELL32|CMD_VAREXPAND, SPLIT_SHELL32, SPLIT_SHELL32|CMD_VAREXPAND|CMD_EXCLMARK):
+            inc = IncrementalCmdSplit('', mode, env)
+            for k in range(400):
+                line = inc.line
+                i = r.randint(0, len(line))
+                j = r.randint(i, min(len(line), i+3))
+                text = ''.join(r.choice(chunks) for c in range(r.randint(0, 2)))
+                try:
+                    argv = cmd_split(line[:i] + text + line[j:], mode, env)
+                except NotExpected:
+                    with p.assertRaises(NotExpected):
+                        inc.edit(i, j, text) if k % 2 else inc.update(line[:i] + text + line[j:])
+                    p.assertIsNone(inc.argv)
+                    continue
+                p.assertEqual(inc.edit(i, j, text) if k % 2 else inc.update(line[:i] + text + line[j:]), argv)
+                p.assertEqual(inc.line, line[:i] + text + line[j:])
+
+    def test_cmd_diagnose(p):
+        "Test the non raising cmd_parse diagnostics"
+        D = Diagnostic
+        for s, tokens, diagnostics in (
+                ('| a (b', ['|', ' a ', '(', 'b'], [D('|', 0, 0), D('(', 4, 2)]),
+                ('a ) b ) c', ['a ', ')', ' b ', ')', ' c'], [D(')', 2, 1), D(')', 6, 3)]),
+                ('() & (a (b) c', ['()', ' ', '&', ' ', '(', 'a ', '(b)', ' c'], [D('()', 0, 0), D('(', 5, 4)]),
+                ('  @&x', ['@', '&', 'x'], [D('&', 3, 1)]),
+                ('(a) ^( "(" x', ['(a)', ' ( "(" x'], [])):
+            p.assertEqual(cmd_diagnose(s), (tokens, diagnostics))
+            if not diagnostics:
+                p.assertEqual(cmd_parse(s), tokens)
+            else:
+                with p.assertRaises(NotExpected) as cm:
+                    cmd_parse(s)
+                p.assertIn(cm.exception.token, [d.code for d in diagnostics])
+        p.assertEqual(cmd_diagnose(')' * 1000, max_diagnostics=2), ([')', ')'], [D(')', 0, 0), D(')', 1, 1)]))
+        # offsets are into the line given, before CR are removed and variables expanded
+        env = Environment({'PATH': 'C:\\Windows;C:\\Tools', 'X': 'a)b'})
+        p.assertEqual(cmd_diagnose('echo %PATH% )', env=env)[1], [D(')', 12, 1)])
+        p.assertEqual(cmd_diagnose('a\r\n)%X%)', env=env)[1], [D(')', 3, 1), D(')', 4, 3), D(')', 7, 5)])
+        p.assertEqual(cmd_diagnose('>a 1', 0), (['>', 'a 1'], [D('>', 0, 0)]))
+
+    def test_split_all_modes(p):
+        "Test the split in all modes at once against split"
+        modes = (SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005, SPLIT_VC98)
+        for s in [case[0] for case in cases] + ['', ' ', 'a\\b "c d"', ' a b', '"C:\\x y\\z.exe" -k', 'x\n a', 'a "b""c" d']:
+            result = split_all_modes(s)
+            p.assertEqual(result.argv, {mode: split(s, mode) for mode in modes})
+            agree = all([result.argv[mode] == result.argv[SPLIT_SHELL32] for mode in modes])
+            p.assertEqual((result.diverge is None, modes_agree(s)), (agree, agree))
+        p.assertEqual(split_all_modes('a "b""c" d').diverge, 5)
+        p.assertEqual(split_all_modes(' a').diverge, 0)
+
+    def test_compile_cmd(p):
+        "Test rendering of batch line templates against substituting and splitting"
+        t = compile_cmd(r'"%~dp0tool.exe" /in:%1 /out:%~dpn1.out %%~nxG %%H 50%% %X:~0,3% >> %TEMP%\log.txt')
+        env = {'TEMP': 'C:\\tmp', 'X': 'abcd'}
+        for args, forvars in [(['C:\\b\\run.bat', 'C:\\d\\f.txt'], {'G': 'D:\\x\\y.z'}),
+                              (['run.bat', '"a b.txt"'], {'G': 'c&d', 'H': '"e f"'}),
+                              ([], None)]:
+            v = [args[0] if args else '', args[1] if len(args) > 1 else '', forvars or {}]
+            dp0 = v[0][:v[0].rfind('\\')+1]
+            name = v[1].strip('"')
+            line = '"%stool.exe" /in:%s /out:%s.out %s %s 50%% abc >> C:\\tmp\\log.txt' % (dp0, v[1],
+                name[:name.rfind('.')], v[2].get('G', '%~nxG').split('\\')[-1], v[2].get('H', '%H'))
+            p.assertEqual(t.render(args, forvars, env), cmd_split(line, 0))
+        p.assertEqual(compile_cmd('echo %1 %* %~x2', 0).render(['b', 'x y', 'z.txt'], cwd='C:\\w'), ['echo', 'x', 'y', 'x', 'y', 'z.txt', '.txt'])
+        p.assertEqual(compile_cmd('copy %~f1 .').render(['', 'a\\b.c'], cwd='C:\\w'), ['copy', 'C:\\w\\a\\b.c', '.'])
+
+    def test_isplit(p):
+        "Test lazy split and cmd_parse, and maxsplit"
+        modes = (SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005, SPLIT_VC98)
+        for s in [case[0] for case in cases] + ['', ' ', ' a  b\t', 'a "b c" d ' * 40, 'x "y']:
+            for mode in modes:
+                p.assertEqual(list(isplit(s, mode)), split(s, mode))
+                p.assertEqual(list(isplit(s.encode(), mode)), split(s.encode(), mode))
+        p.assertEqual(split('  a "b c"  d e  ', maxsplit=2), ['a', 'b c', 'd e  '])
+        p.assertEqual(split('"a b"  c', SPLIT_ARGV0, maxsplit=1), ['a b', 'c'])
+        p.assertEqual(split(' a b ', maxsplit=0), ['a b '])
+        p.assertEqual(split('a b ', maxsplit=2), ['a', 'b'])
+        args = isplit('a ' + '"b\\" ' * 5000)
+        p.assertEqual(next(args), 'a')
+        for s in ('a b', '@a b|c', '(a b) && c', 'a 2>&1 >x.log', 'a b>c&d||e', '((a b c))', 'a/b c', 'a "b c" ^& d', '@^,a'):
+            p.assertEqual(list(icmd_parse(s)), cmd_parse(s))
+        p.assertEqual(cmd_parse('a ^| b | c 2>&1 d', maxsplit=1), ['a | b ', '| c 2>&1 d'])
+        p.assertEqual(cmd_parse('a ^| b | c 2>&1 d', maxsplit=3), ['a | b ', '|', ' c ', '2>&1 d'])
+        tokens = icmd_parse('a | b ' + '(' * 20)
+        p.assertEqual(next(tokens), 'a ')
+        p.assertRaises(NotExpected, list, tokens)
+
+
+    def test_delayed_expansion(p):
+        "Test !variables! are expanded once parsed, their values being never syntax"
+        env = Environment({'X': 'a&b', 'Y': '(x', 'Z': 'q"r|s)'})
+        mode = SPLIT_SHELL32|CMD_EXCLMARK
+        p.assertEqual(cmd_parse('x!X!', mode, env), ['xa&b'])
+        p.assertEqual(cmd_parse('echo !Y!', mode, env), ['echo (x'])
+        p.assertEqual(cmd_parse('(echo !Z!) & y!X!', mode, env), ['(echo q"r|s))', ' ', '&', ' ya&b'])
+        p.assertEqual(cmd_split('echo !X! !Y! done', mode, env), ['echo', 'a&b', '(x', 'done'])
+        p.assertEqual(cmd_tree('(echo !X!) & y', mode, env).tokens(), ['(echo a&b)', ' ', '&', ' y'])
+        bat = BatchFile('setlocal EnableDelayedExpansion\r\necho !X! !Y! done\r\n', env=env)
+        p.assertEqual(list(bat)[1].tokens, ['echo a&b (x done'])
+
 if __name__ == '__main__':
     if os.name != 'nt':
-        print('Nothing to test outside Windows')
+        unittest.main(defaultTest='portable')
     else:
         unittest.main()
@@ -3,327 +3,1224 @@ COPYRIGHT = '''Copyright (C)2024, by maxpat78.'''
 __version__ = '1.0.8'
 
 import os
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 
 class NotExpected(Exception):
     def __init__ (p, s):
         super().__init__(s + ' is not expected')
+        p.token = s
+
+    def __reduce__(p):
+        # rebuild from the token, so that it crosses process boundaries
+        return (type(p), (p.token,))
+
+
+class LimitExceeded(ValueError):
+    def __init__ (p, limit, value):
+        super().__init__('%s limit of %d exceeded' % (limit, value))
+        p.limit = limit # 'length', 'depth' or 'tokens'
+        p.value = value
+
+    def __reduce__(p):
+        return (type(p), (p.limit, p.value))
+
+
+MAX_CMDLINE = 32767 # CreateProcess command line limit
+
+class Limits:
+    """Budgets for split and cmd_parse inputs: maximum length of the command
+    line (also once variables are expanded), parenthesis nesting depth and
+    tokens returned. None disables a limit. Inputs are bounded only when a
+    Limits object is passed: Limits() applies the CreateProcess length."""
+    __slots__ = ('length', 'depth', 'tokens')
+
+    def __init__ (p, length=MAX_CMDLINE, depth=None, tokens=None):
+        p.length = length
+        p.depth = depth
+        p.tokens = tokens
+
+    def check(p, limit, value):
+        "Raise LimitExceeded if value exceeds the named limit"
+        maximum = getattr(p, limit)
+        if maximum is not None and value > maximum:
+            raise LimitExceeded(limit, maximum)
+
+_LIMITS = Limits(None) # no limits, unless asked
 
 
 SPLIT_SHELL32 = 0 # CommandLineToArgvW (and pre-2005 VC Runtime) mode (default)
 SPLIT_ARGV0   = 1 # full compatibility: simplified parsing of argv[0]
 SPLIT_VC2005  = 2 # enable VC2005+ handling of quoted double quote
+SPLIT_VC98    = 16 # enable STDARGV98.C (VC6) handling of quoted double quote
 CMD_VAREXPAND = 4 # expand %variables%
 CMD_EXCLMARK  = 8 # expand delayed expansion !variables!
+CMD_NT        = 32 # Windows NT CMD dialect (default: Windows 2000+)
+CMD_COMMAND   = 64 # DOS COMMAND.COM dialect
 
 
-def split(s, mode=SPLIT_SHELL32):
+def split(s, mode=SPLIT_SHELL32, codepage=None, limits=None, maxsplit=-1):
     """Split a command line like CommandLineToArgvW (SHELL32) or old parse_cmdline
     (VC Runtime) with mode=SPLIT_SHELL32 (default). With mode=SPLIT_ARGV0, do
     special simplified parsing for first argument; with mode=SPLIT_VC2005, emulate
-    2005 and newer parse_cmdline."""
-    argv = []       # resulting arguments list
-    arg = ''        # current argument
-    quoted = 0      # if current argument is quoted
-    backslashes = 0 # backslashes in a row
-    quotes = 0      # quotes in a row
-    space = 0       # whitespace in a row
-
-    if not s: return []
-
-    # CommandLineToArgvW parses first argument (executable pathname) in a simplified way
-    # It collects everything up to first space if unquoted, or second quote otherwise
-    if mode&1:
-        i=0
-        for c in s:
-            i += 1
-            if c == '"':
-                if quoted: break # 2nd " ends arg
-                if i == 1: # 1st char only: start quoting
-                    quoted = not quoted
-                    continue
-            if c in ' \t':
-                if quoted: # include white space if quoted
-                    arg += c
-                    continue
-                break # else ends arg
-            arg += c
-        argv += [arg]
-        arg=''
-        quoted = 0
-        s = s[i:] # strip processed string
-
-    s = s.strip() # strip leading and trailing whitespace
-    if not s: return argv
-    
-    # Special rules:
-    # Quotes (consecutive or not):
-    #  " open block;
-    #  "" open and close block;
-    #  """ open, add literal " and close block (not VC Runtime 2005+)
-    # Backslashes, if followed by ":
-    #  2n -> n, and open/close block
-    #  (2n+1) -> n, and add literal "
-    for c in s:
-        # count backslashes
-        if c == '\\':
-            space = 0 # reset count
-            backslashes += 1
-            continue
-        if c == '"':
-            space = 0  # reset count
-            if backslashes:
+    2005 and newer parse_cmdline; with mode=SPLIT_VC98, emulate STDARGV98.C.
+    A bytes-like command line is split as is, like the narrow (MBCS) runtime
+    does, in codepage (a Python codec name, needed for double byte ones only):
+    arguments are then returned as bytes. limits (a Limits object, if given) bounds the
+    length of s and the arguments count. If maxsplit is not negative, at most
+    maxsplit arguments are split, followed by the rest of the line unparsed."""
+    if maxsplit > -1:
+        return list(isplit(s, mode, codepage, limits, maxsplit))
+    if limits is None: limits = _LIMITS
+    if s: limits.check('length', len(s))
+    if type(s) is not str and s:
+        argv = _bytes_parser(mode, codepage).split(_bytes(s))
+    else:
+        argv = (_parsers.get(mode) or _parser(mode)).split(s)
+    if limits.tokens is not None: limits.check('tokens', len(argv))
+    return argv
+
+def isplit(s, mode=SPLIT_SHELL32, codepage=None, limits=None, maxsplit=-1):
+    """Split a command line like split, but return an iterator yielding each
+    argument as soon as it is scanned: taking the first ones costs only the
+    characters they span. If maxsplit is not negative, the rest of the line
+    after maxsplit arguments is yielded as is, like str.split does."""
+    if limits is None: limits = _LIMITS
+    if s: limits.check('length', len(s))
+    if type(s) is not str and s:
+        args = _bytes_parser(mode, codepage).iterate(_bytes(s), maxsplit)
+    else:
+        args = (_parsers.get(mode) or _parser(mode)).iterate(s, maxsplit)
+    if limits.tokens is not None: return _bounded(args, limits.tokens)
+    return args
+
+def _bytes(s):
+    "Return a bytes-like command line as bytes, raising TypeError if s is not one"
+    if not isinstance(s, (bytes, bytearray, memoryview)):
+        raise TypeError('expected str or a bytes-like object, not %s' % type(s).__name__)
+    return bytes(s)
+
+def _bounded(tokens, limit):
+    "Yield tokens, raising LimitExceeded once more than limit are"
+    for count, token in enumerate(tokens, 1):
+        if count > limit: raise LimitExceeded('tokens', limit)
+        yield token
+
+# Special rules:
+# Quotes (consecutive or not):
+#  " open block;
+#  "" open and close block;
+#  """ open, add literal " and close block (not VC Runtime 2005+)
+# Backslashes, if followed by ":
+#  2n -> n, and open/close block
+#  (2n+1) -> n, and add literal "
+#
+# Each dialect describes how its parser state st = quoted + 2*quotes (if the
+# current argument is quoted, and the quotes in a row, up to 2) changes on:
+#  quote: a quote, also telling the literal " it adds, if any;
+#  escaped: a quote escaped by an odd number of backslashes;
+#  slashes: an even number of backslashes before a quote;
+#  other: a run of any other characters.
+# tail tells if blanks trailing an unterminated quoted argument are kept.
+# A table lookup per quote and per run costs about what the mode tests it
+# replaces did: where quotes are dense, chars avoids the per run costs.
+_Dialect = namedtuple('_Dialect', 'quote escaped slashes other tail')
+
+_DIALECTS = {
+    # 3" in a row unquoted or 2" quoted -> add a literal " and toggle quoting
+    SPLIT_SHELL32: _Dialect(
+        quote=((3, ''), (2, ''), (0, '"'), (4, ''), (0, '"'), (1, '"')),
+        escaped=(0, 1, 2, 3, 4, 5), slashes=(0, 1, 2, 3, 4, 5), other=(0, 1, 0, 1, 0, 1), tail=0),
+    # new parse_cmdline does NOT change quoting
+    SPLIT_VC2005: _Dialect(
+        quote=((3, ''), (2, ''), (1, '"'), (4, ''), (1, '"'), (0, '"')),
+        escaped=(0, 1, 2, 3, 4, 5), slashes=(0, 1, 2, 3, 4, 5), other=(0, 1, 0, 1, 0, 1), tail=0),
+    # a quote closing a block and the one right after it -> add a literal "
+    SPLIT_VC98: _Dialect(
+        quote=((3, ''), (2, ''), (0, '"'), (2, ''), (3, ''), (2, '')),
+        escaped=(0, 1, 0, 1, 0, 1), slashes=(0, 1, 0, 1, 0, 1), other=(0, 1, 0, 1, 0, 1), tail=1),
+}
+
+_Parser = namedtuple('_Parser', 'split runs spans tail iterate')
+_DENSE = 6 # lines with more than a quote every _DENSE chars are split char by char
+_parsers = {} # mode, or (mode, codepage) for bytes -> _Parser
+_leads = {}   # codepage -> lead bytes
+
+def _dialect(mode):
+    dialect = _DIALECTS.get(mode & (SPLIT_VC2005|SPLIT_VC98))
+    if dialect is None:
+        raise ValueError('incompatible split modes in %d' % mode)
+    return dialect
+
+def _parser(mode):
+    "Return the parser functions specialized for mode, building them when first used"
+    parser = _parsers.get(mode)
+    if parser is None:
+        key = mode & (SPLIT_ARGV0|SPLIT_VC2005|SPLIT_VC98)
+        parser = _parsers.get(key)
+        if parser is None:
+            parser = _parsers[key] = _build(key & SPLIT_ARGV0, _dialect(key))
+        _parsers[mode] = parser
+    return parser
+
+def _bytes_parser(mode, codepage):
+    "Return the parser functions specialized for mode, for bytes in codepage"
+    key = (mode & (SPLIT_ARGV0|SPLIT_VC2005|SPLIT_VC98), codepage)
+    parser = _parsers.get(key)
+    if parser is None:
+        parser = _parsers[key] = _build(mode & SPLIT_ARGV0, _dialect(mode), _lead_bytes(codepage))
+    return parser
+
+def _lead_bytes(codepage):
+    """Return the lead bytes of a double byte codepage, whose trail bytes can
+    be a backslash. Single byte codepages and UTF-8 have none: their multibyte
+    characters never contain ASCII bytes."""
+    lead = _leads.get(codepage)
+    if lead is None:
+        lead = set()
+        ascii_trail = 0 # if some character has an ASCII trail byte
+        if codepage is not None:
+            for b in range(0x80, 0x100):
+                for t in range(0x40, 0x100):
+                    try:
+                        if len(bytes([b, t]).decode(codepage)) == 1:
+                            lead.add(b)
+                            ascii_trail |= t < 0x80
+                    except UnicodeDecodeError:
+                        pass
+        if not ascii_trail: lead = ()
+        lead = _leads[codepage] = frozenset(lead)
+    return lead
+
+def _trail(s, i, k, lead):
+    "Tell if s[k] is the trail byte of a double byte character, scanning from character boundary i"
+    while i < k:
+        i += 2 if s[i] in lead else 1
+    return i > k
+
+def _backslashes(s, i, j, lead):
+    "Return the start of the backslashes in a row ending at j, not before i, in bytes"
+    k = j
+    while k > i and s[k-1] == 92: k -= 1
+    if lead and i < k < j and s[k-1] in lead and _trail(s, i, k, lead):
+        k += 1 # first one is a trail byte
+    return k
+
+def _build(argv0, dialect, lead=None, rules=None):
+    """Build the parser functions of a dialect, with the simplified parsing of
+    the first argument if argv0: mode and dialect are bound here, so that
+    nothing but the parser state is tested while scanning. With lead (the lead
+    bytes of a codepage), the functions parse bytes. rules, if given, wraps
+    the transition tables (see metrics.instrument)."""
+    QUOTE = tuple([t[0] for t in dialect.quote])
+    LITERAL = tuple([t[1] for t in dialect.quote])
+    ESCAPED, SLASHES, OTHER = dialect.escaped, dialect.slashes, dialect.other
+    tail = dialect.tail
+    if rules:
+        QUOTE, ESCAPED, SLASHES, OTHER = rules(QUOTE, ESCAPED, SLASHES, OTHER)
+    # characters (and backslash code) of str or bytes
+    q, bs, bscode, sp, tab, empty = '"', '\\', '\\', ' ', '\t', ''
+    if lead is not None:
+        q, bs, bscode, sp, tab, empty = b'"', b'\\', 92, b' ', b'\t', b''
+        LITERAL = tuple([c.encode() for c in LITERAL])
+
+    def argv0_end(s):
+        """Return start and end of the first argument of a non empty command line,
+        parsed in the simplified SPLIT_ARGV0 way: everything up to first blank if
+        unquoted, or second quote otherwise"""
+        if s[:1] == q:
+            i = s.find(q, 1)
+            if i < 0: i = len(s)
+            return 1, i
+        i = s.find(sp)
+        if i < 0: i = len(s)
+        j = s.find(tab, 0, i)
+        if j > -1: i = j
+        return 0, i
+
+    def runs(s, argv, arg=empty, st=0):
+        """Append to argv the arguments completed in the stripped command line s,
+        and return the state (arg, st) to carry on with: arg is the current
+        argument, st the parser state. Only quotes are special, since backslashes
+        count just before a quote: runs of other characters are reached with
+        str.find and processed at once (outside quotes, they are split at blanks
+        with str.split)."""
+        n = len(s)
+        find = s.find
+        i = 0           # scan position
+        while 1:
+            j = find(q, i)
+            if j < 0: j = n
+            # backslashes in a row before the quote
+            k = j
+            if j < n:
+                while k > i and s[k-1] == bscode: k -= 1
+                if lead and k < j and k > i and s[k-1] in lead and _trail(s, i, k, lead):
+                    k += 1 # first one is a trail byte
+            if k > i:
+                if st & 1:
+                    # quoted: append whitespace, too
+                    arg += s[i:k]
+                else:
+                    run = s[i:k].replace(tab, sp).split(sp)
+                    if len(run) > 1:
+                        # unquoted blanks end arguments; ignore whitespace in excess
+                        argv += [arg + run[0]]
+                        argv += filter(None, run[1:-1])
+                        arg = run[-1]
+                    else:
+                        arg += run[0]
+                st = OTHER[st]
+            if j == n: break
+            i = j + 1
+            if k < j:
                 # take 2n, emit n
-                arg += '\\' * (backslashes//2)
-                if backslashes%2:
+                arg += bs * ((j-k)//2)
+                if (j-k)%2:
                     # if odd, add the escaped literal quote
-                    arg += c
-                    backslashes = 0
+                    arg += q
+                    st = ESCAPED[st]
                     continue
+                st = SLASHES[st]
+            arg += LITERAL[st]
+            st = QUOTE[st]
+        return arg, st
+
+    def chars(s, argv, arg=empty, st=0):
+        """Same as runs, character by character (for str): where quotes are
+        dense, runs are short and finding and slicing each of them costs more
+        than this loop."""
+        backslashes = 0 # backslashes in a row
+        run = 0         # if a run of other characters is going on
+        space = 0       # if the last character is an unquoted blank
+        for c in s:
+            if c == '\\':
+                backslashes += 1
+                space = 0
+                continue
+            if c == '"':
+                if backslashes:
+                    # take 2n, emit n
+                    arg += '\\' * (backslashes//2)
+                    if backslashes%2:
+                        # if odd, add the escaped literal quote
+                        arg += c
+                        st = ESCAPED[st]
+                        backslashes = run = space = 0
+                        continue
+                    st = SLASHES[st]
+                    backslashes = 0
+                arg += LITERAL[st]
+                st = QUOTE[st]
+                run = space = 0
+                continue
+            if not run:
+                st = OTHER[st]
+                run = 1
+            if backslashes:
+                arg += '\\' * backslashes
                 backslashes = 0
-            quoted = not quoted
-            quotes += 1
-            # 3" in a row unquoted or 2" quoted -> add a literal "
-            if quotes == 3 or quotes == 2 and quoted:
-                arg += c
-                quoted = not quoted
-                if mode&2:
-                    quoted = not quoted # new parse_cmdline does NOT change quoting
-                quotes = 0
-            continue
+            if c in ' \t' and not st & 1:
+                # unquoted blanks end arguments; ignore whitespace in excess
+                if not space:
+                    argv += [arg]
+                    arg = ''
+                    space = 1
+                continue
+            space = 0
+            arg += c
         if backslashes:
-            # simply append the backslashes
+            if not run: st = OTHER[st]
             arg += '\\' * backslashes
-        quotes = backslashes = 0
-        if c in ' \t':
-            if quoted:
-                # append whitespace
-                arg += c
-                continue
-            # ignore whitespace in excess between arguments
-            if not space:
-                # append argument
-                argv += [arg]
-                arg = ''
-            space += 1
-            continue
-        space = 0
-        # append normal char
-        arg += c
-    if backslashes:
-        arg += '\\' * backslashes
-    # append last arg
-    argv += [arg]
-    return argv
+        return arg, st
+
+    def spans(s, base, offsets, flags):
+        """Append to offsets the (start, end) offsets, moved by base, of the
+        arguments in the stripped command line s, and to flags if they contain
+        quotes; return the final parser state. Same scanning as runs, but no
+        argument is built."""
+        n = len(s)
+        find = s.find
+        st = 0          # parser state
+        start = base    # current argument start
+        flag = 0        # if current argument contains quotes
+        i = 0           # scan position
+        while 1:
+            j = find(q, i)
+            if j < 0: j = n
+            # backslashes in a row before the quote
+            k = j
+            if j < n:
+                while k > i and s[k-1] == bscode: k -= 1
+                if lead and k < j and k > i and s[k-1] in lead and _trail(s, i, k, lead):
+                    k += 1 # first one is a trail byte
+            if k > i:
+                if not st & 1:
+                    run = s[i:k].replace(tab, sp).split(sp)
+                    if len(run) > 1:
+                        # unquoted blanks end arguments; ignore whitespace in excess
+                        pos = base + i + len(run[0])
+                        offsets += [start, pos]
+                        flags += [flag]
+                        for arg in run[1:-1]:
+                            pos += 1
+                            if arg:
+                                offsets += [pos, pos+len(arg)]
+                                flags += [0]
+                                pos += len(arg)
+                        start = pos + 1
+                        flag = 0
+                st = OTHER[st]
+            if j == n: break
+            i = j + 1
+            flag = 1
+            if k < j:
+                if (j-k)%2:
+                    st = ESCAPED[st]
+                    continue # escaped literal quote
+                st = SLASHES[st]
+            st = QUOTE[st]
+        offsets += [start, base+n]
+        flags += [flag]
+        return st
+
+    def rest(s):
+        "Split the command line (following the first argument, if argv0)"
+        if not s: return []
+        t = s.strip() # strip leading and trailing whitespace
+        if not t: return []
+        if q not in t:
+            # backslashes are literal without quotes: just split at blanks
+            return list(filter(None, t.replace(tab, sp).split(sp)))
+        argv = []
+        if lead is None and t.count(q) * _DENSE > len(t):
+            arg, st = chars(t, argv)
+        else:
+            arg, st = runs(t, argv)
+        if st & tail:
+            # blanks trailing an unterminated quote belong to the last argument
+            arg += s[len(s.rstrip()):]
+        # append last arg
+        argv += [arg]
+        return argv
+
+    def rest_spans(s, base, offsets, flags):
+        # strip leading and trailing whitespace
+        t = s.lstrip()
+        base += len(s) - len(t)
+        stripped = t.rstrip()
+        if stripped and spans(stripped, base, offsets, flags) & tail:
+            # blanks trailing an unterminated quote belong to the last argument
+            offsets[-1] += len(t) - len(stripped)
+
+    def items(s, i, maxsplit):
+        """Yield the arguments of s[i:], stripped, as soon as each one is
+        scanned: the next quote, blank and tab are searched again only once
+        passed, so that the whole line is scanned once. After maxsplit
+        arguments (if not negative), yield the rest of the line as is."""
+        n = len(s)
+        while i < n and s[i:i+1].isspace(): i += 1
+        while n > i and s[n-1:n].isspace(): n -= 1
+        find = s.find
+        blanks = sp + tab
+        nq = ns = nt = -1 # next quote, space and tab (at or after i, or n)
+        count = 0
+        size = 64 # window split at blanks at once, doubled when used
+        while i < n:
+            if count == maxsplit:
+                yield s[i:]
+                return
+            if nq < i:
+                nq = find(q, i, n)
+                if nq < 0: nq = n
+            if maxsplit < 0 and nq - i > 1:
+                # with no quotes ahead, the arguments up to the last blank before
+                # the window end are split with str.split
+                w = i + size
+                if w > nq: w = nq
+                b = max(s.rfind(sp, i, w), s.rfind(tab, i, w))
+                if b > i:
+                    args = s[i:b].replace(tab, sp).split(sp)
+                    if empty in args: args = list(filter(None, args))
+                    yield from args
+                    i = b + 1
+                    while s[i:i+1] in (sp, tab):
+                        w = s[i:i+64]
+                        i += len(w) - len(w.lstrip(blanks))
+                    size += size
+                    continue
+            arg = empty
+            st = 0
+            while 1:
+                if nq < i:
+                    nq = find(q, i, n)
+                    if nq < 0: nq = n
+                j = k = nq
+                if j < n:
+                    while k > i and s[k-1] == bscode: k -= 1
+                    if lead and k < j and k > i and s[k-1] in lead and _trail(s, i, k, lead):
+                        k += 1 # first one is a trail byte
+                if k > i:
+                    if not st & 1:
+                        if ns < i:
+                            ns = find(sp, i, n)
+                            if ns < 0: ns = n
+                        if nt < i:
+                            nt = find(tab, i, n)
+                            if nt < 0: nt = n
+                        b = ns if ns < nt else nt
+                        if b < k:
+                            # unquoted blank: the argument ends
+                            arg += s[i:b]
+                            i = b
+                            break
+                    arg += s[i:k]
+                    st = OTHER[st]
+                if j == n:
+                    if st & tail:
+                        # blanks trailing an unterminated quote belong to the last argument
+                        arg += s[n:]
+                    i = n
+                    break
+                i = j + 1
+                if k < j:
+                    arg += bs * ((j-k)//2)
+                    if (j-k)%2:
+                        arg += q
+                        st = ESCAPED[st]
+                        continue
+                    st = SLASHES[st]
+                arg += LITERAL[st]
+                st = QUOTE[st]
+            yield arg
+            count += 1
+            while s[i:i+1] in (sp, tab):
+                w = s[i:i+64]
+                i += len(w) - len(w.lstrip(blanks))
+
+    if argv0:
+        # CommandLineToArgvW parses first argument (executable pathname) in a simplified way
+        def split(s):
+            if not s: return []
+            start, end = argv0_end(s)
+            argv = [s[start:end]]
+            argv += rest(s[end+1:])
+            return argv
+
+        def split_spans(s, mode):
+            offsets = [] # start, end pairs
+            flags = []
+            if s:
+                start, end = argv0_end(s)
+                offsets += [start, end]
+                flags += [0]
+                rest_spans(s[end+1:], end+1, offsets, flags)
+            return Spans(s, mode, array('I', offsets), bytearray(flags))
+
+        def iterate(s, maxsplit):
+            if not s: return
+            if maxsplit == 0:
+                yield s
+                return
+            start, end = argv0_end(s)
+            yield s[start:end]
+            yield from items(s, end+1, maxsplit-1)
+    else:
+        split = rest
+
+        def split_spans(s, mode):
+            offsets = [] # start, end pairs
+            flags = []
+            rest_spans(s, 0, offsets, flags)
+            return Spans(s, mode, array('I', offsets), bytearray(flags))
+
+        def iterate(s, maxsplit):
+            return items(s, 0, maxsplit) if s else iter(())
+
+    return _Parser(split, runs, split_spans, tail, iterate)
+
+class Spans:
+    """Arguments of a command line as (start, end) offsets into it, kept in an
+    array('I') of start and end pairs, and flags telling which arguments need
+    unescaping: arguments are materialized only when accessed."""
+    __slots__ = ('s', 'mode', 'offsets', 'flags')
+
+    def __init__ (p, s, mode, offsets, flags):
+        p.s = s
+        p.mode = mode
+        p.offsets = offsets # start, end of each argument
+        p.flags = flags     # 1 if an argument needs unescaping
+
+    def __len__(p):
+        return len(p.flags)
+
+    def span(p, i):
+        "Return the (start, end) offsets of i-th argument"
+        i = range(len(p.flags))[i]
+        return p.offsets[2*i], p.offsets[2*i+1]
+
+    def __getitem__(p, i):
+        if isinstance(i, slice):
+            return [p[j] for j in range(len(p.flags))[i]]
+        start, end = p.span(i)
+        if not p.flags[i]:
+            return p.s[start:end]
+        # a quoted argument begins and ends with no quotes and blanks pending
+        return _parser(p.mode).runs(p.s[start:end], [])[0]
+
+    def __iter__(p):
+        for i in range(len(p.flags)):
+            yield p[i]
+
+def split_spans(s, mode=SPLIT_SHELL32):
+    """Split a command line like split, but return its arguments as a Spans
+    object: the offsets into s where each argument lies and if it needs
+    unescaping. The first argument parsed by SPLIT_ARGV0 never needs it, so
+    its span excludes the enclosing quotes, if any."""
+    return (_parsers.get(mode) or _parser(mode)).spans(s, mode)
 
-def quote(s):
-    "Quote a string in a way suitable for the split function"
-    backslashes = 0 # backslashes in a row
+def quote(s, codepage=None):
+    "Quote a string (or bytes in codepage) in a way suitable for the split function"
+    if type(s) is not str and s is not None:
+        return _quote_bytes(_bytes(s), _lead_bytes(codepage))
     if not s: return '""'
-    arg = ''
-    for c in s:
-        # count backslashes
-        if c == '\\':
-            backslashes += 1
-            continue
-        if c == '"':
-            if backslashes:
-                # take n, emit 2n
-                arg += '\\' * (2*backslashes)
-                backslashes = 0
-            # escape the "
-            arg += '\\"'
-            continue
-        if backslashes:
-            # add literally
-            arg += backslashes*'\\'
-            backslashes = 0
-        arg += c
-    # any backslash left?
-    if backslashes:
-        arg += backslashes*'\\'
+    blank = ' ' in s or '\t' in s
+    # plain paths and switches are returned unchanged
+    if not blank and '"' not in s: return s
+    arg = s
+    if '"' in s and '\\' not in s:
+        # escape the "
+        arg = s.replace('"', '\\"')
+    elif '"' in s:
+        # take n backslashes before a quote, emit 2n, then escape the "
+        arg = ''
+        i = 0
+        j = s.find('"')
+        while j > -1:
+            k = j
+            while k > i and s[k-1] == '\\': k -= 1
+            arg += s[i:j] + s[k:j] + '\\"'
+            i = j + 1
+            j = s.find('"', i)
+        arg += s[i:]
     # quote only when needed
-    for c in ' \t': # others?
-        if c in arg:
-            if backslashes:
-                arg += backslashes*'\\' # double backslashes at quoted EOS
-            arg = '"'+arg+'"'
-            break
+    if blank: # others?
+        # double backslashes at quoted EOS
+        arg = '"' + arg + (len(s) - len(s.rstrip('\\')))*'\\' + '"'
+    return arg
+
+def _quote_bytes(s, lead):
+    "quote for bytes, whose double byte characters start with lead bytes"
+    if not s: return b'""'
+    blank = b' ' in s or b'\t' in s
+    if not blank and b'"' not in s: return s
+    # take n backslashes before a quote, emit 2n, then escape the "
+    arg = b''
+    i = 0
+    j = s.find(b'"')
+    while j > -1:
+        arg += s[i:j] + s[_backslashes(s, i, j, lead):j] + b'\\"'
+        i = j + 1
+        j = s.find(b'"', i)
+    arg += s[i:]
+    if blank:
+        # double backslashes at quoted EOS
+        arg = b'"' + arg + s[_backslashes(s, i, len(s), lead):] + b'"'
     return arg
 
-def join(argv):
-    "Quote and join list items, so that split returns the same"
-    return ' '.join([quote(arg) for arg in argv])
+def join(argv, codepage=None):
+    "Quote and join list items (str, or bytes in codepage), so that split returns the same"
+    if type(argv) not in (list, tuple): argv = list(argv)
+    if argv and type(argv[0]) is not str:
+        return b' '.join([quote(arg, codepage) for arg in argv])
+    line = ' '.join(argv)
+    # if no item is empty or contains quotes or blanks, nothing to quote
+    if not ('"' in line or '\t' in line or '' in argv or line.count(' ') >= len(argv)):
+        return line
+    return ' '.join(map(quote, argv))
 
+def join_chunks(argv, max_len=MAX_CMDLINE-1, prefix=(), cmd=0):
+    """Quote and join arguments, like xargs, into the fewest command lines not
+    longer than max_len (default: CreateProcess limit, less the NUL), each
+    starting with the prefix arguments, so that split (or cmd_split, if cmd)
+    returns prefix plus the next arguments. Raise LimitExceeded if prefix and
+    an argument cannot fit in a line."""
+    q = cmd_quote if cmd else quote
+    head = [q(arg) for arg in prefix]
+    base = len(' '.join(head))
+    line = head[:]
+    size = base # len(' '.join(line)), kept without joining
+    for arg in argv:
+        arg = q(arg)
+        n = len(arg) + (1 if line else 0)
+        if size + n > max_len and len(line) > len(head):
+            yield ' '.join(line)
+            line = head[:]
+            size = base
+            n = len(arg) + (1 if line else 0)
+        if size + n > max_len:
+            raise LimitExceeded('length', max_len)
+        line += [arg]
+        size += n
+    if len(line) > len(head):
+        yield ' '.join(line)
 
 
 #
 # cmd_ function are an attempt to provide a lexer/parser/tokenizer for Windows CMD
 #
 
-def cmd_parse(s, mode=SPLIT_SHELL32|CMD_VAREXPAND):
-    "Pre-process a command line like Windows CMD Command Prompt"
+# cmd_parse character classes
+_OTHER, _QUOTE, _CARET, _SLASH, _OPEN, _CLOSE, _REDIRECT, _OPERATOR = range(8)
+
+_CmdDialect = namedtuple('_CmdDialect', 'marks classes leading single label echo_off operators '
+                                        'doubles handles delayed start_escape start_ignore')
+
+def _cmd_dialect(classes, **profile):
+    """Build a cmd_parse dialect from its special characters classes: they are
+    marked with NUL by str.translate, so that the others are skipped at once"""
+    classes = dict(classes, **{'\0': _OTHER}) # a NUL in the line is not special
+    marks = str.maketrans(dict.fromkeys(classes, '\0'))
+    return _CmdDialect(marks, classes, **profile)
+
+def _marked(s, table, i):
+    """Return a find(c, j) over s translated by table, from offset i on, for
+    growing j: windows of s are translated as the scan goes on, so that a
+    parse resumed near the end of a long line does not translate all of it"""
+    window = [i, i, ''] # start, end, translated
+    def find(c, j):
+        start, end, text = window
+        while 1:
+            k = text.find(c, j - start) if j < end else -1
+            if k >= 0 or end == len(s): return k + start if k >= 0 else -1
+            j = max(j, end)
+            start, end = end, min(len(s), end + max(64, 2*(end - start)))
+            text = s[start:end].translate(table)
+            window[:] = start, end, text
+    return find
+
+_CMD_CLASSES = {'"': _QUOTE, '^': _CARET, '/': _SLASH, '(': _OPEN, ')': _CLOSE,
+                '<': _REDIRECT, '>': _REDIRECT, '|': _OPERATOR, '&': _OPERATOR}
+
+_CMD_DIALECTS = {
+    # Windows 2000+ CMD
+    0: _cmd_dialect(_CMD_CLASSES, leading=' ;,=\t\x0B\x0C\xFF', single='', label=1, echo_off=1,
+        operators='|&<>', doubles='|&>', handles=1, delayed=1, start_escape=',;=', start_ignore=''),
+    # Windows NT CMD: ':' or '^' and a separator at line start
+    CMD_NT: _cmd_dialect(_CMD_CLASSES, leading=' ;,=\t\x0B\x0C\xFF', single='', label=0, echo_off=1,
+        operators='|&<>', doubles='|&>', handles=1, delayed=1, start_escape='', start_ignore=' ,;=\t'),
+    # DOS COMMAND.COM: no ^, &, &&, ||, (), numeric handles, delayed expansion, nor @ outside BAT files
+    CMD_COMMAND: _cmd_dialect({'"': _QUOTE, '/': _SLASH, '<': _REDIRECT, '>': _REDIRECT, '|': _OPERATOR},
+        leading=' \t\x0B\x0C\xFF', single=';,=', label=1, echo_off=0,
+        operators='|<>', doubles='>', handles=0, delayed=0, start_escape='', start_ignore=''),
+}
+
+def cmd_parse(s, mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None, limits=None, maxsplit=-1):
+    """Pre-process a command line like Windows CMD Command Prompt. Variables
+    are looked up in env mapping, if given, or in os.environ. limits (a Limits
+    object) bounds the length of s, also once expanded, the parenthesis
+    nesting depth and the tokens count. If maxsplit is not negative, at most
+    maxsplit tokens are parsed, followed by the rest of the line unparsed."""
+    if maxsplit > -1:
+        return list(_cmd_tokens(s, mode, env, None, limits, None, 1, maxsplit))
+    return _cmd_parse(s, mode, env, None, limits)
+
+def icmd_parse(s, mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None, limits=None, maxsplit=-1):
+    """Parse a command line like cmd_parse, but return an iterator yielding
+    each token as soon as it is complete (a parenthesized trait, once closed):
+    taking the first command or pipeline segment stops parsing there. Errors
+    are raised when reached. If maxsplit is not negative, the rest of the
+    line after maxsplit tokens is yielded as is."""
+    return _cmd_tokens(s, mode, env, None, limits, None, 1, maxsplit)
+
+def cmd_tree(s, mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None, limits=None):
+    """Parse a command line like cmd_parse, but return it as a tree of
+    Sequence, Conditional, Pipeline, Command, Group and Redirect nodes"""
+    groups = []
+    return _sequence(_cmd_parse(s, mode, env, groups, limits), dict(groups))
+
+def cmd_diagnose(s, mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None, limits=None, max_diagnostics=None):
+    """Parse a command line like cmd_parse, but go on after the errors it
+    raises NotExpected for: return the tokens and a list of Diagnostic(code,
+    offset, index), where code is the unexpected token, offset its position
+    in s (that of the variable, if it comes from an expanded one) and index
+    the position of its token. Parsing stops after max_diagnostics, if given."""
+    diagnostics = _Diagnostics()
+    diagnostics.limit = max_diagnostics
+    diagnostics.crs = diagnostics.spans = ()
+    tokens = _cmd_parse(s, mode, env, None, limits, diagnostics)
+    return tokens, list(diagnostics)
+
+def _flatten(rope):
+    "Join a parenthesized trait, kept as nested lists of tokens, in linear time"
+    out = []
+    stack = [iter(rope)]
+    while stack:
+        for piece in stack[-1]:
+            if type(piece) == list:
+                stack += [iter(piece)]
+                break
+            out += [piece]
+        else:
+            stack.pop()
+    return ''.join(out)
+
+Diagnostic = namedtuple('Diagnostic', 'code offset index')
+
+class _Diagnostics(list):
+    "Diagnostics collected by cmd_diagnose"
+    __slots__ = ('limit', 'crs', 'spans')
+
+    def report(p, code, offset, index):
+        "Record a diagnostic (unless enough were), telling if no more are wanted"
+        if p.limit is None or len(p) < p.limit:
+            p.append(Diagnostic(code, p.origin(offset), index))
+        return p.limit is not None and len(p) >= p.limit
+
+    def origin(p, offset):
+        """Map an offset in the parsed line back to the caller's one, through
+        the spans of _expand and the CR removed (at crs, once removed)"""
+        k = bisect_left(p.spans, (offset+1,)) - 1
+        if k > -1:
+            start, origin, literal = p.spans[k]
+            offset = origin + (offset - start if literal else 0)
+        return offset + bisect_right(p.crs, offset)
+
+def _cmd_parse(s, mode, env, groups, limits=None, diagnostics=None):
+    """cmd_parse worker. If groups is a list, (position, Group node) pairs of
+    parenthesized traits are collected there, while they are tokenized. If
+    diagnostics is a _Diagnostics list, errors are reported there instead of
+    raised, and parsing goes on. Every step is linear in the line length."""
+    return list(_cmd_tokens(s, mode, env, groups, limits, diagnostics))
+
+def _cmd_tokens(s, mode, env, groups, limits=None, diagnostics=None, lazy=0, maxsplit=-1, marks=None, resume=None):
+    """Generator of the tokens of _cmd_parse. If lazy, tokens outside
+    parenthesis are yielded as soon as they are complete, else all at the
+    end. After maxsplit tokens (if not negative), the rest of the line is
+    yielded as is, with %variables% expanded but unparsed. Where the state
+    is reset (outside quotes and parenthesis, past the first word), marks
+    (if given) is called with the offset, the token index and the token so
+    far: parsing stops if it returns true. resume=(offset, token so far)
+    goes on from such a point of s, with no line start rules."""
+    dialect = _CMD_DIALECTS.get(mode & (CMD_NT|CMD_COMMAND))
+    if dialect is None:
+        raise ValueError('incompatible CMD dialects in %d' % mode)
+    if env is None: env = os.environ
+    if limits is None: limits = _LIMITS
+    limits.check('length', len(s))
     escaped = 0
     quoted = 0
-    percent = 0
-    exclamation = 0
     parenthesis = [] # opened parenthesis (argv position)
     arg = ''
     argv = []
 
     # ignore CR, should handle LF?
+    if diagnostics is not None and '\r' in s:
+        diagnostics.crs = [j-k for k, j in enumerate([j for j, c in enumerate(s) if c == '\r'])]
     s = s.replace('\r','')
 
-    # remove (ignore) some leading chars
-    for c in ' ;,=\t\x0B\x0C\xFF': s = s.lstrip(c)
-    
-    if not s or s[0] == ':': return []
-    
-    # push and strip special "line echo off" char
-    while s[0] == '@':
-        argv = ['@']
-        s = s[1:]
-    # some combinations at line start are prohibited
-    if s[0] in '|&<>':
-        raise NotExpected(s[0])
+    # %VAR%   -> replace with env['VAR'] *if set* and even if quoted
+    # ^%VAR%  -> same as above
+    # %VAR^%
+    # ^%VAR^% -> keep literal %VAR%
+    # %%VAR%% -> replace internal %VAR% only
+    # NOTE: batch arguments %0..%9 and %* should be recognized?
+    # TBD: FOR parsing, %G and %%G and tilded vars
+    if mode&CMD_VAREXPAND:
+        spans = None
+        if diagnostics is not None: spans = diagnostics.spans = []
+        s = _expand(s, env, '%', limits.length, spans)
+    # !VAR! -> replaced in the parsed tokens (delayed expansion): its value
+    # is never syntax
+    delayed = mode&CMD_EXCLMARK and dialect.delayed
 
+    full = len(s) # to tell offsets, once leading chars are stripped
+
+    if resume is None:
+        # remove (ignore) some leading chars
+        s = s.lstrip(dialect.leading)
+        if s and s[0] in dialect.single: s = s[1:]
+
+        if not s: return
+        if maxsplit == 0:
+            yield s
+            return
+        if s[0] == ':':
+            if dialect.label: return
+            if diagnostics is None: raise NotExpected(':')
+            # taken as text
+            if diagnostics.report(':', full-len(s), 0): return
+
+        # push and strip special "line echo off" chars
+        if s[0] == '@':
+            if dialect.echo_off:
+                argv = ['@']
+                s = s.lstrip('@')
+                if not s:
+                    yield '@'
+                    return
+            elif diagnostics is None:
+                raise NotExpected('@')
+            elif diagnostics.report('@', full-len(s), 0):
+                return
+        # some combinations at line start are prohibited
+        if s[0] in dialect.operators:
+            if diagnostics is None: raise NotExpected(s[0])
+            if diagnostics.report(s[0], full-len(s), len(argv)):
+                yield from argv
+                return
+
+    classes = dialect.classes
+    doubles = dialect.doubles
+    handles = dialect.handles
+    depth = limits.depth
+    n = len(s)
+    blank = s.find(' ') # first blank, for the / rule
+    if blank < 0: blank = n
     i = 0
-    while i < len(s):
-        c = s[i]
-        i += 1
-        if c == '"':
+    done = 0 # tokens yielded
+    mark = 0 # start of the last operator token, for maxsplit
+    if resume is not None:
+        # past the first word: the / rule is over
+        i, arg = resume
+        blank = -1
+    elif s[0] == '^' and n > 1 and classes.get('^') == _CARET:
+        # exception (Windows 2000+): starting special char escaped
+        if s[1] in dialect.start_escape:
+            argv += [s[1]]
+            i = 2
+        # else the line is ignored (Windows NT)
+        elif s[1] in dialect.start_ignore:
+            return
+
+    skipped = full - n # leading chars stripped
+    opened = [] # offsets of opened parenthesis, if diagnosing
+    # special characters are marked with NUL: the others are copied in runs
+    if resume is None:
+        find = s.translate(dialect.marks).find
+    else:
+        find = _marked(s, dialect.marks, i)
+    while 1:
+        if marks is not None and not (quoted or escaped or parenthesis) and (argv or blank < i) \
+           and i and s[i-1] not in '012': # a handle can be taken back from the token
+            if marks(skipped+i, len(argv), arg): break
+        if lazy and len(argv) > done and not parenthesis:
+            # complete tokens (at most an argument and the operator ending it)
+            if limits.tokens is not None: limits.check('tokens', len(argv))
+            if -1 < maxsplit < len(argv):
+                yield from _delayed(argv[done:maxsplit], delayed, env, limits)
+                yield s[mark:]
+                return
+            yield from _delayed(argv[done:], delayed, env, limits)
+            done = len(argv)
+            if done == maxsplit:
+                rest = s[i-len(arg):] # a / starting the next token is pending
+                if rest: yield rest
+                return
+        j = find('\0', i)
+        if j < 0: j = n
+        if j > i:
+            arg += s[i:j]
+            escaped = 0
+        if j == n: break
+        c = s[j]
+        i = j + 1
+        cls = classes[c]
+        if cls == _QUOTE:
             if not escaped: quoted = not quoted
-        if c == '^':
+        elif cls == _CARET:
             # ^CRLF (middle and at end) is well handled?
-            if escaped or quoted:
-                arg += c
-                escaped = 0
-            else:
+            if not (escaped or quoted):
                 escaped = 1
-            continue
-        if c == '(' and not (escaped or quoted):
+                continue
+        elif cls == _OPEN and not (escaped or quoted):
             if arg:
                 argv += [arg]
                 arg = ''
             argv += [c]
             parenthesis += [len(argv)-1]
+            if depth is not None and len(parenthesis) > depth:
+                raise LimitExceeded('depth', depth)
+            if diagnostics is not None: opened += [skipped+j]
             continue
-        if c == ')' and not (escaped or quoted):
+        elif cls == _CLOSE and not (escaped or quoted):
             if arg:
                 argv += [arg]
                 arg = ''
             if not parenthesis:
-                raise NotExpected(')')
-            last_opened = parenthesis.pop()
-            # replaces parenthesized trait with a single argument
-            argv[last_opened:] = [''.join(argv[last_opened:])+')']
-            if argv[-1] == '()':
-                raise NotExpected('()')
-            continue
-        # at line start: abcd/e -> acd /e
-        if c == '/' and not (argv or quoted or ' ' in arg):
-            argv += [arg+' ']
-            arg = c
-            continue
-        # %VAR%   -> replace with os.environ['VAR'] *if set* and even if quoted
-        # ^%VAR%  -> same as above
-        # %VAR^%
-        # ^%VAR^% -> keep literal %VAR%
-        # %%VAR%% -> replace internal %VAR% only
-        # NOTE: batch arguments %0..%9 and %* should be recognized?
-        # TBD: FOR parsing, %G and %%G and tilded vars
-        if c == '%' and (mode&CMD_VAREXPAND):
-            arg += c
-            if percent and percent != i-1:
-                if not escaped:
-                    vname = s[percent:i-1]
-                    val = os.environ.get(vname)
-                    #~ print('debug: "%s": trying to replace var "%s" with "%s"' %(s,vname,val))
-                    if val: arg = arg.replace('%'+vname+'%', val)
-                percent = 0
+                if diagnostics is None: raise NotExpected(')')
+                # taken as a token of its own
+                argv += [c]
+                mark = j
+                if diagnostics.report(')', skipped+j, len(argv)-1): break
                 continue
-            percent = i # record percent position
+            last_opened = parenthesis.pop()
+            if diagnostics is not None: opened.pop()
+            if len(argv) == last_opened+1:
+                if diagnostics is None: raise NotExpected('()')
+                if diagnostics.report('()', skipped+j-1, last_opened): break
+            if groups is not None:
+                # build the Group from the tokens (and inner groups) it replaces
+                inner = {}
+                while groups and groups[-1][0] > last_opened:
+                    k, node = groups.pop()
+                    inner[k-last_opened-1] = node
+                groups += [(last_opened, _group(_delayed(argv[last_opened+1:], delayed, env, limits), inner))]
+            # replaces parenthesized trait with a single argument: inner ones
+            # are kept as lists of tokens, and joined with the outermost one
+            rope = argv[last_opened:] + [')']
+            argv[last_opened:] = [rope if parenthesis else _flatten(rope)]
             continue
-        if c == '!' and (mode&CMD_EXCLMARK):
-            arg += c
-            if exclamation and exclamation != i-1:
-                if not escaped:
-                    vname = s[exclamation:i-1]
-                    val = os.environ.get(vname)
-                    #~ print('debug: "%s": trying to replace var "%s" with "%s"' %(s,vname,val))
-                    if val: arg = arg.replace('!'+vname+'!', val)
-                exclamation = 0
+        elif cls == _SLASH:
+            # at line start: abcd/e -> acd /e
+            if not (argv or quoted or blank < j):
+                argv += [arg+' ']
+                arg = c
                 continue
-            exclamation = i # record exclamation mark position
-            continue
-        # <,>,>>,&,&&,|,|| w/o blanks delimit 2 args
-        # " n>>&m" is the longest symbolic redirection
-        if c in '012' and s[i-2] == ' ' and i < len(s) and s[i] in '<>':
-            n=i+1 # index of next char in sequence
-            if s[i] == '>' and n < len(s) and s[n] == '>': # optional 2nd >
-                n+=1
+        elif cls == _REDIRECT and handles and j > 0 and s[j-1] in '012' and (j < 2 or s[j-2] == ' '):
+            # " n>>&m" is the longest symbolic redirection
+            k = i # index of next char in sequence
+            if c == '>' and k < n and s[k] == '>': # optional 2nd >
+                k+=1
             # note: cmd recognizes n>^&m as valid as n>&m (!)
-            if n+3 < len(s) and s[n] == '^' and s[n+1] == '&' and s[n+2] in '012':
-                n+=3
-            if n+2 < len(s) and s[n] == '&' and s[n+1] in '012':
-                n+=2
+            if k+2 < n and s[k] == '^' and s[k+1] == '&' and s[k+2] in '012':
+                k+=3
+            if k+1 < n and s[k] == '&' and s[k+1] in '012':
+                k+=2
+            arg = arg[:-1] # the handle
             if arg: argv += [arg]
             arg = ''
-            argv += [s[i-1:n].replace('^','')] # eventually fix weird case above
-            i = n
+            argv += [s[j-1:k].replace('^','')] # eventually fix weird case above
+            mark = j-1
+            i = k
             continue
-        if c in '|<>&':
-            if escaped or quoted:
-                arg += c
-                escaped = 0
-                continue
+        elif cls >= _REDIRECT and not (escaped or quoted):
+            # <,>,>>,&,&&,|,|| w/o blanks delimit 2 args
             if arg: argv += [arg]
-            arg = ''
-            if i < len(s) and s[i] != '<' and s[i] == c: # if doubled
+            arg = c
+            mark = j
+            if c in doubles and i < n and s[i] == c: # if doubled
                 arg = 2*c
                 i+=1
-            else:
-                arg += c
-            if arg in ('>','<','>>','<<') and i < len(s) and s[i] == '&' and s[i+1] in '012': # if valid handle redir
+            if handles and arg in ('>','<','>>') and i+1 < n and s[i] == '&' and s[i+1] in '012': # if valid handle redir
                 arg += '&'+s[i+1]
                 i+=2
             argv += [arg]
             arg = ''
             continue
-        if c in ' ,;=\t':
-            percent = 0
-            # exception (Windows 2000+): starting special char escaped
-            if i==2 and escaped and c in ',;=':
-                argv += [c]
-                escaped = 0
-                continue
         arg += c
         escaped = 0
     if arg: argv += [arg]
     # if any unclosed parenthesis
     if parenthesis:
-        raise NotExpected('(')
-    return argv
+        if diagnostics is None: raise NotExpected('(')
+        for k, offset in zip(parenthesis, opened):
+            if diagnostics.report('(', offset, k): break
+        # inner groups are left as lists of tokens
+        argv = [_flatten(tok) if type(tok) == list else tok for tok in argv]
+    if limits.tokens is not None: limits.check('tokens', len(argv))
+    yield from _delayed(argv[done:], delayed, env, limits)
+
+def _delayed(tokens, delayed, env, limits):
+    "Expand !variables! in parsed tokens (but in inner groups, kept as lists), if delayed"
+    if not delayed: return tokens
+    return [_expand(tok, env, '!', limits.length) if type(tok) == str else tok for tok in tokens]
+
+class Environment:
+    """Case insensitive snapshot of environment variables (of os.environ, by
+    default), indexed once and reusable with any number of command lines"""
+    __slots__ = ('_vars',)
+
+    def __init__ (p, env=None):
+        if env is None: env = os.environ
+        p._vars = {name.upper(): val for name, val in env.items()}
+
+    def get(p, name, default=None):
+        return p._vars.get(name.upper(), default)
 
-def cmd_split(s, mode=SPLIT_SHELL32|CMD_VAREXPAND):
-    "Post-process with split a command line parsed by cmd_parse"
+    def __getitem__(p, name):
+        return p._vars[name.upper()]
+
+    def __contains__(p, name):
+        return name.upper() in p._vars
+
+    def __len__(p):
+        return len(p._vars)
+
+    def __iter__(p):
+        return iter(p._vars)
+
+def _expand(s, env, marker, limit=None, spans=None):
+    """Expand variables enclosed by marker (% or !) in s, in a single left to
+    right pass: unset variables are kept literally. Besides VAR, the CMD forms
+    VAR:~n,m (substring) and VAR:old=new (substitution) are recognized.
+    LimitExceeded is raised as soon as the result grows longer than limit.
+    If a spans list is given, (offset, origin, literal) are appended to it
+    where values and the text after them start in the result."""
+    if marker not in s: return s
+    if limit is None: limit = -1
+    size = len(s) # result length
+    out = []
+    i = 0
+    for j, k, name in _pairs(s, marker):
+        if name is None: continue
+        val = _variable(name, env)
+        if val is not None:
+            out += [s[i:j], val]
+            shift = size - len(s) # of offsets in the result, so far
+            size += len(val) - (k+1-j)
+            if spans is not None:
+                spans += [(j+shift, j, 0), (k+1+size-len(s), k+1, 1)]
+            if size > limit > -1:
+                raise LimitExceeded('length', limit)
+            i = k+1
+        # unset variables are left in place
+    out += [s[i:]]
+    return ''.join(out)
+
+def _pairs(s, marker, i=0):
+    """Yield (j, k, name) for each pair of markers at j and k that the scan of
+    s from i meets: name is None if they do not enclose a variable name, and
+    the scan goes on from the second one, else from k+1"""
+    find = s.find
+    while 1:
+        j = find(marker, i)
+        if j < 0: return
+        k = find(marker, j+1)
+        if k < 0: return
+        name = s[j+1:k]
+        if marker == '%':
+            # a delimiter resets %, except in the edit of VAR:~n,m or VAR:old=new
+            head, sep, edit = name.partition(':')
+            if not (head and (edit[:1] == '~' or '=' in edit)):
+                head = name
+        else:
+            head = ''
+        if not name or _delimited(head):
+            # doubled marker, or a name broken by a delimiter: the second
+            # marker can open a variable
+            yield j, k, None
+            i = k
+            continue
+        yield j, k, name
+        i = k+1
+
+def _delimited(name):
+    "Tell if name contains a CMD argument delimiter"
+    for c in ' ,;=\t':
+        if c in name: return 1
+    return 0
+
+def _variable(name, env):
+    "Return the value of a variable reference like VAR, VAR:~n,m or VAR:old=new, or None"
+    i = name.find(':')
+    if i < 0:
+        return env.get(name)
+    val = env.get(name[:i])
+    if not val: return None
+    edit = name[i+1:]
+    if edit[:1] == '~':
+        # substring: n (from end, if negative) and length m (up to m from end, if negative)
+        n, sep, m = edit[1:].partition(',')
+        try:
+            n = int(n)
+            m = int(m) if sep else None
+        except ValueError:
+            return None
+        if n < 0: n = max(len(val)+n, 0)
+        if m is None: return val[n:]
+        if m < 0: return val[n:len(val)+m]
+        return val[n:n+m]
+    old, sep, new = edit.partition('=')
+    if not sep or not old:
+        return None
+    # case insensitive substitution; *old replaces everything up to old, too
+    low = val.lower()
+    star = old[0] == '*'
+    if star:
+        old = old[1:]
+        if not old: return None
+    old = old.lower()
+    out = []
+    i = 0
+    j = low.find(old)
+    if star:
+        if j < 0: return val
+        return new + val[j+len(old):]
+    while j > -1:
+        out += [val[i:j], new]
+        i = j + len(old)
+        j = low.find(old, i)
+    out += [val[i:]]
+    return ''.join(out)
+
+_UNSPLIT = ('@','<','|','>','<<','>>','&','&&','||') # tokens cmd_split passes as they are
+
+def cmd_split(s, mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None, limits=None):
+    """Post-process with split a command line parsed by cmd_parse, or
+    a tree returned by cmd_tree"""
     argv = []
-    for tok in cmd_parse(s, mode):
-        if tok in ('@','<','|','>','<<','>>','&','&&','||'):
+    if isinstance(s, Node):
+        tokens = s.tokens()
+    else:
+        tokens = cmd_parse(s, mode, env, limits)
+    for tok in tokens:
+        if tok in _UNSPLIT:
             argv += [tok]
             continue
         argv += split(tok)
     return argv
 
 def cmd_quote(s):
-    "Quote a string in a way suitable for the cmd_split function"
-    # suitable means [x] equals (or is equivalent to) cmd_split(cmd_quote(x))
-    arg = ''
-    for c in s:
-        if c in ('^%!<|>&'): arg += '^' # escape the escapable!
-        arg += c
-    if (' ' in arg) or ('\\' in arg):
-         # quote only when special split chars inside,
-         # since quote() always insert into double quotes!
-         # CAVE: no more true! 19.10.24
-        arg = quote(arg)
-    return arg
+    """Quote a string in a way suitable for the cmd_split function: quote it
+    like quote, then caret escape CMD special characters. Its quotes too are
+    escaped, so that CMD never sees a quoted stretch (where carets would be
+    literal) and the following arguments are not affected; a / (splitting the
+    first word of a line) is enclosed in a CMD quoted stretch of its own.
+    Raise ValueError for a CR, that CMD drops, and for quotes alone between
+    two / (like a/"/b), which such stretches cannot enclose."""
+    # suitable means [x] equals cmd_split(cmd_quote(x)), wherever x is in a line
+    if '\r' in s: raise ValueError('a CR cannot be passed through CMD')
+    arg = quote(s)
+    if arg[0] in _CMD_HEAD:
+        # dropped or special at line start, unless quoted
+        arg = '"' + arg + (len(arg) - len(arg.rstrip('\\')))*'\\' + '"'
+    out = []
+    run = 0 # backslashes just emitted
+    slash = 0 # in a CMD quoted stretch of /
+    for k, c in enumerate(arg):
+        if c == '/' and k:
+            if not slash:
+                out += [run*'\\' + '"']
+                slash = 1
+            # the stretch goes on past backslashes, up to the last /
+            t = arg[k+1:].lstrip('\\')
+            if t[:1] != '/':
+                if t[:1] == '"' and t.lstrip('\\"')[:1] == '/':
+                    # a quote after a closing one is literal for split
+                    raise ValueError('quotes between / cannot be passed through CMD')
+                c += '"'
+                slash = 0
+        elif (c in _CMD_SPECIALS or arg[k-1:k] == '%') and not slash:
+            # a caret after % too, so that no variable name follows it
+            out += ['^']
+        out += [c]
+        run = run + 1 if c == '\\' else 0
+    return ''.join(out)
+
+_CMD_SPECIALS = '^&|<>()"%!'
+_CMD_HEAD = ':;,=@\x0B\x0C\xFF' # dropped or special at line start
+
+from .parallel import split_many, cmd_split_many, INLINE, THREAD, PROCESS
+from .cache import SplitCache
+from .lexer import W32Lexer
+from .cmdtree import Node, Sequence, Conditional, Pipeline, Command, Group, Redirect, _sequence, _group
+from .batfile import BatchFile, BatchLine
+from .metrics import instrument, stats, reset_stats
+from .columnar import split_array, SplitArray
+from .aio import split_async, cmd_split_async
+from .table import ArgvTable, ArgvRow
+from .incremental import IncrementalSplit, IncrementalCmdSplit
+from .modes import split_all_modes, modes_agree, ModeSplit
+from .template import compile_cmd, CmdTemplate
@@ -0,0 +1,179 @@
+"""Command line tool: python -m w32lex {split,cmd-split,quote,join} [FILE]
+
+Processes a file (memory-mapped, in byte ranges ending at line boundaries,
+sharded across worker processes) or standard input, one record per line,
+writing JSON Lines or NUL terminated output in input order."""
+
+import sys, os, json, mmap, argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from . import split, cmd_split, quote, join, NotExpected, \
+    SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005, SPLIT_VC98, CMD_VAREXPAND, CMD_EXCLMARK, CMD_NT, CMD_COMMAND
+
+_MODES = {'SHELL32': SPLIT_SHELL32, 'ARGV0': SPLIT_ARGV0, 'VC2005': SPLIT_VC2005, 'VC98': SPLIT_VC98,
+          'VAREXPAND': CMD_VAREXPAND, 'EXCLMARK': CMD_EXCLMARK, 'NT': CMD_NT, 'COMMAND': CMD_COMMAND}
+
+_DEFAULT_MODES = {'split': SPLIT_SHELL32, 'cmd-split': SPLIT_SHELL32|CMD_VAREXPAND}
+
+_COMMANDS = {'split': split, 'cmd-split': cmd_split,
+             'quote': lambda s, mode: quote(s), 'join': lambda argv, mode: join(argv)}
+
+
+def parse_mode(s):
+    "Parse a --mode value: names like argv0 or SPLIT_ARGV0, or numbers, joined by , or |"
+    mode = 0
+    for name in s.replace('|', ',').split(','):
+        name = name.strip().upper()
+        if name.isdigit():
+            mode |= int(name)
+            continue
+        for prefix in ('SPLIT_', 'CMD_'):
+            if name.startswith(prefix): name = name[len(prefix):]
+        if name not in _MODES:
+            raise argparse.ArgumentTypeError('unknown mode %r' % name)
+        mode |= _MODES[name]
+    return mode
+
+def _ranges(path, chunksize):
+    "Yield (start, end) byte ranges of a file, about chunksize long and ending at line boundaries"
+    size = os.path.getsize(path)
+    if not size: return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = start + chunksize
+            if end < size:
+                end = mm.find(b'\n', end) + 1 or size
+            else:
+                end = size
+            yield start, end
+            start = end
+
+def _blocks(stream, chunksize):
+    "Yield blocks of whole lines, about chunksize long, read from a binary stream"
+    rest = b''
+    while 1:
+        block = stream.read(chunksize)
+        if not block: break
+        block = rest + block
+        i = block.rfind(b'\n') + 1
+        rest = block[i:]
+        if i: yield block[:i]
+    if rest: yield rest
+
+def _record(rec, command):
+    "Return a JSON record, raising TypeError unless it is a string (a list of strings, to join)"
+    if command == 'join':
+        if type(rec) is not list or not all([type(arg) is str for arg in rec]):
+            raise TypeError('join records must be arrays of strings')
+    elif type(rec) is not str:
+        raise TypeError('%s records must be strings' % command)
+    return rec
+
+def _work(opts, path=None, start=0, end=0, data=None):
+    """Worker: process the lines in data, or in bytes start:end of file path,
+    returning the output bytes, the failed records count and the first error"""
+    if data is None:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[start:end]
+    mode = opts.mode
+    if mode is None: mode = _DEFAULT_MODES.get(opts.command)
+    func = _COMMANDS[opts.command]
+    jsonl = opts.jsonl or opts.field is not None or opts.command == 'join'
+    out = []
+    errors = 0
+    error = None
+    lines = data.decode(opts.encoding, 'surrogateescape').split('\n')
+    if lines[-1] == '': lines.pop()
+    for line in lines:
+        if line[-1:] == '\r': line = line[:-1]
+        if jsonl and not line.strip(): continue
+        try:
+            rec = line
+            if jsonl:
+                rec = json.loads(line)
+                if opts.field is not None: rec = rec[opts.field]
+                rec = _record(rec, opts.command)
+            res = func(rec, mode)
+        except (ValueError, LookupError, TypeError, NotExpected) as e:
+            errors += 1
+            if error is None: error = '%s: %s' % (type(e).__name__, e)
+            res = None
+        if not opts.nul:
+            out += [json.dumps(res, ensure_ascii=False), '\n']
+        elif type(res) == list:
+            # arguments NUL terminated, records newline terminated
+            out += [''.join([arg + '\0' for arg in res]), '\n']
+        elif res is not None:
+            out += [res, '\0']
+        else:
+            out += ['\n' if opts.command in _DEFAULT_MODES else '\0']
+    encoding = opts.encoding if opts.nul else 'utf-8'
+    return ''.join(out).encode(encoding, 'surrogateescape'), errors, error
+
+def _tasks(opts):
+    if opts.input == '-':
+        for data in _blocks(sys.stdin.buffer, opts.chunk_size):
+            yield opts, None, 0, 0, data
+    else:
+        for start, end in _ranges(opts.input, opts.chunk_size):
+            yield opts, opts.input, start, end
+
+def _results(opts):
+    "Yield _work results in input order, from a pool of workers if worth it"
+    workers = opts.workers or os.cpu_count() or 1
+    if workers == 1 or opts.input != '-' and os.path.getsize(opts.input) <= opts.chunk_size:
+        for task in _tasks(opts):
+            yield _work(*task)
+        return
+    # keep a bounded number of ranges in flight, so that memory stays bounded
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for task in _tasks(opts):
+            pending += [pool.submit(_work, *task)]
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m w32lex', description='Split, quote and join Windows command lines in bulk')
+    ap.add_argument('command', choices=('split', 'cmd-split', 'quote', 'join'),
+        help='split (or cmd-split) each line; quote each line as an argument; join each JSON array of arguments')
+    ap.add_argument('input', nargs='?', default='-', help='input file, memory-mapped (default: standard input)')
+    ap.add_argument('-o', '--output', default='-', help='output file (default: standard output)')
+    ap.add_argument('--mode', type=parse_mode,
+        help='split mode: shell32, argv0, vc2005, vc98, varexpand, exclmark, nt, command, joined by commas (default: shell32, and varexpand with cmd-split)')
+    ap.add_argument('--jsonl', action='store_true', help='input is JSON Lines')
+    ap.add_argument('--field', help='take each record from this field of JSON Lines objects (implies --jsonl)')
+    ap.add_argument('--nul', action='store_true',
+        help='write NUL terminated arguments, with newline terminated records (or NUL terminated strings), instead of JSON Lines')
+    ap.add_argument('--encoding', default='utf-8', help='input (and NUL output) encoding (default: utf-8)')
+    ap.add_argument('--workers', type=int, default=0, help='worker processes (default: one per CPU)')
+    ap.add_argument('--chunk-size', type=int, default=1<<22, help='bytes of input per task (default: 4 MiB)')
+    opts = ap.parse_args(argv)
+
+    if opts.output == '-':
+        out = sys.stdout.buffer
+    else:
+        out = open(opts.output, 'wb')
+    errors = 0
+    error = None
+    try:
+        for data, failed, first in _results(opts):
+            out.write(data)
+            errors += failed
+            if error is None: error = first
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        else:
+            out.flush()
+    if errors:
+        sys.stderr.write('w32lex: %d records failed, first with %s\n' % (errors, error))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"Asyncio streaming split of command lines read from StreamReaders or async iterators"
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from . import SPLIT_SHELL32, CMD_VAREXPAND
+from .parallel import _split_chunk, _unpack, INLINE
+
+
+async def _lines(source, encoding):
+    "Yield the lines of a StreamReader or async iterator of str or bytes, without terminators"
+    async for line in source:
+        if type(line) is not str:
+            line = line.decode(encoding, 'surrogateescape')
+        if line[-1:] == '\n': line = line[:-1]
+        if line[-1:] == '\r': line = line[:-1]
+        yield line
+
+async def _ready(task):
+    "Tell if task is done, once it had a chance to run"
+    if not task.done():
+        await asyncio.sleep(0)
+    return task.done()
+
+async def _split(batch, mode, cmd, executor, env):
+    "Split a batch of lines on the event loop (then yielding control) or in executor"
+    if executor is None:
+        results = _split_chunk(batch, mode, cmd, 0, env)
+        await asyncio.sleep(0)
+        return results
+    pack = isinstance(executor, ProcessPoolExecutor)
+    loop = asyncio.get_running_loop()
+    return _unpack(await loop.run_in_executor(executor, _split_chunk, batch, mode, cmd, pack, env))
+
+def _run(source, mode, cmd, executor, budget, encoding, env=None):
+    if executor in (None, INLINE):
+        executor = None
+    elif not isinstance(executor, Executor):
+        raise ValueError('unknown executor %r' % (executor,))
+    return _streamed(source, mode, cmd, executor, budget, encoding, env)
+
+async def _streamed(source, mode, cmd, executor, budget, encoding, env):
+    lines = _lines(source, encoding).__aiter__()
+    batch = []      # lines read, not split yet
+    size = 0        # their characters
+    pending = None  # next line being read
+    try:
+        while 1:
+            if pending is None:
+                pending = asyncio.ensure_future(lines.__anext__())
+            # lines are collected while already available, up to budget
+            if batch and (size >= budget or not await _ready(pending)):
+                for argv in await _split(batch, mode, cmd, executor, env):
+                    yield argv
+                batch = []
+                size = 0
+            try:
+                line = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+            batch += [line]
+            size += len(line) + 1
+        if batch:
+            for argv in await _split(batch, mode, cmd, executor, env):
+                yield argv
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+def split_async(source, mode=SPLIT_SHELL32, executor=INLINE, budget=65536, encoding='utf-8'):
+    """Split the lines read from an asyncio.StreamReader or an async iterator
+    of lines (str, or bytes in encoding) with split, returning an async
+    iterator of argument lists, in input order. Lines already available are
+    split in batches of about budget characters, after which control goes
+    back to the event loop; with an executor (a concurrent.futures.Executor)
+    batches are split there. Lines are read only as results are consumed."""
+    return _run(source, mode, 0, executor, budget, encoding)
+
+def cmd_split_async(source, mode=SPLIT_SHELL32|CMD_VAREXPAND, executor=INLINE, budget=65536, encoding='utf-8', env=None):
+    """Like split_async, but splits each line with cmd_split, expanding
+    variables from env (an Environment snapshot is best) or os.environ"""
+    return _run(source, mode, 1, executor, budget, encoding, env)
@@ -0,0 +1,150 @@
+"Streaming parser of batch (.bat, .cmd) files"
+
+import io
+from collections import namedtuple
+
+from . import cmd_parse, NotExpected, LimitExceeded, SPLIT_SHELL32, CMD_VAREXPAND, CMD_EXCLMARK
+
+# a logical line: number and offset (in characters) of its first physical
+# line, text, cmd_parse tokens, label name if a label, exception if any
+BatchLine = namedtuple('BatchLine', 'lineno offset text tokens label error')
+
+_SEPARATORS = ' ;,=\t\x0B\x0C\xFF'
+_LABEL_END = ' \t,;=+:<>|&('
+_MARKS = str.maketrans(dict.fromkeys('"^()', '\0'))
+
+
+def _scan(line, escaped):
+    """Return the parentheses opened less the closed ones in a physical line,
+    outside quotes and not escaped, and if its final ^ escapes the newline.
+    If escaped, the first character is escaped by the previous line."""
+    find = line.translate(_MARKS).find
+    depth = 0
+    quoted = 0
+    i = 1 if escaped else 0
+    n = len(line)
+    while 1:
+        j = find('\0', i)
+        if j < 0: return depth, 0
+        c = line[j]
+        i = j + 1
+        if c == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif c == '^':
+            if i == n: return depth, 1
+            i += 1 # skip the escaped character
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+
+def _head(line):
+    "Strip the leading separators and @ of a line, returning if @ was found, too"
+    s = line.lstrip(_SEPARATORS)
+    if s[:1] == '@':
+        return 1, s.lstrip('@')
+    return 0, s
+
+def _is_rem(s):
+    "Tell if a line (without its head) is a REM comment"
+    return s[:3].upper() == 'REM' and (len(s) == 3 or s[3] in ' \t,;=/')
+
+
+class BatchFile:
+    """Parse a batch file read from a text stream (or a string), yielding a
+    BatchLine for each logical line while iterating: lines continued by a
+    final ^ and multi-line parenthesized blocks are joined (a newline inside
+    a block separates commands like &), REM comments are not tokenized, and
+    :labels are indexed as they are met. SETLOCAL ENABLEDELAYEDEXPANSION (up
+    to DISABLEDELAYEDEXPANSION or the matching ENDLOCAL) adds CMD_EXCLMARK to
+    mode for the lines following."""
+    def __init__ (p, instream, mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None, limits=None):
+        if isinstance(instream, str):
+            instream = io.StringIO(instream)
+        p.instream = instream
+        p.mode = mode
+        p.env = env
+        p.limits = limits
+        p.labels = {}       # lowercase label -> (lineno, offset) of its line
+        p.delayed = 0       # if delayed expansion is enabled
+        p._setlocal = []    # delayed expansion states saved by SETLOCAL
+
+    def __iter__(p):
+        return p._lines()
+
+    def label(p, name):
+        """Return (lineno, offset) of the line of a GOTO or CALL target (like
+        'name' or ':name'), or None if not found in the lines read so far"""
+        return p.labels.get(name.lstrip(':').lower())
+
+    def _lines(p):
+        lineno = 0
+        offset = 0
+        parts = []      # physical lines of the logical line being collected
+        start = None    # its lineno and offset
+        depth = 0       # parenthesized blocks open
+        escaped = 0     # if previous line ended with an escaping ^
+        comment = 0     # if the logical line is a REM
+        for raw in p.instream:
+            lineno += 1
+            line = raw[:-1] if raw[-1:] == '\n' else raw
+            if line[-1:] == '\r': line = line[:-1]
+            pos = offset
+            offset += len(raw)
+            if escaped:
+                # the newline is escaped: go on with this line (or the next, if empty)
+                parts += [line]
+                if not line: continue
+            elif depth:
+                # a newline inside a block separates commands
+                s = line.strip(_SEPARATORS)
+                if not s: continue
+                sep = ' & '
+                if parts[-1].rstrip().endswith('(') or s[0] == ')': sep = ' '
+                parts += [sep, line]
+            else:
+                echo_off, s = _head(line)
+                if not s: continue
+                start = (lineno, pos)
+                if s[0] == ':':
+                    # label (or :: comment): the rest of the line is ignored
+                    i = 1
+                    while i < len(s) and s[i] not in _LABEL_END: i += 1
+                    name = s[1:i].lower()
+                    if name and name not in p.labels:
+                        p.labels[name] = start
+                    yield BatchLine(lineno, pos, line, [], name or None, None)
+                    continue
+                parts = [line]
+                comment = _is_rem(s)
+            opened, continued = _scan(line, escaped)
+            escaped = continued
+            if not comment:
+                depth = max(depth + opened, 0)
+            if escaped or depth:
+                continue
+            yield p._parse(start, ''.join(parts), comment)
+        if parts and (escaped or depth):
+            yield p._parse(start, ''.join(parts), comment)
+
+    def _parse(p, start, text, comment):
+        "Tokenize a logical line, and follow SETLOCAL and ENDLOCAL"
+        echo_off, s = _head(text)
+        if comment:
+            return BatchLine(start[0], start[1], text, ['@', s] if echo_off else [s], None, None)
+        mode = p.mode
+        if p.delayed: mode |= CMD_EXCLMARK
+        try:
+            tokens = cmd_parse(text, mode, p.env, p.limits)
+        except (NotExpected, LimitExceeded) as e:
+            return BatchLine(start[0], start[1], text, None, None, e)
+        words = s[:200].upper().split()
+        if words and words[0] == 'SETLOCAL':
+            p._setlocal += [p.delayed]
+            if 'ENABLEDELAYEDEXPANSION' in words: p.delayed = 1
+            if 'DISABLEDELAYEDEXPANSION' in words: p.delayed = 0
+        elif words and words[0] == 'ENDLOCAL' and p._setlocal:
+            p.delayed = p._setlocal.pop()
+        return BatchLine(start[0], start[1], text, tokens, None, None)
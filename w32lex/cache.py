@@ -0,0 +1,99 @@
+"Bounded LRU memoization of split, cmd_split and quote"
+
+import os
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+from . import split, cmd_split, quote, SPLIT_SHELL32, CMD_VAREXPAND, CMD_EXCLMARK
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class _EnvRecorder:
+    "Environment wrapper recording the variables looked up and their values"
+    def __init__ (p, env):
+        p.env = env
+        p.used = {}
+
+    def get(p, name, default=None):
+        val = p.env.get(name)
+        p.used[name] = val
+        if val is None: return default
+        return val
+
+
+class SplitCache:
+    """Bounded LRU cache of split, cmd_split and quote results, keyed on
+    (input, mode). Results depending on environment variables are kept with
+    the values they were expanded with, and recomputed if any changed."""
+    def __init__ (p, maxsize=4096):
+        p.maxsize = maxsize
+        p.hits = p.misses = 0
+        p._entries = OrderedDict()
+        p._lock = Lock()
+
+    def _get(p, key, env=None):
+        "Look key up; with env, check the variables an entry was expanded with"
+        with p._lock:
+            entry = p._entries.get(key)
+            if entry is not None and env is not None:
+                for name, val in entry[1]:
+                    if env.get(name) != val:
+                        entry = None # stale expansion
+                        break
+            if entry is None:
+                p.misses += 1
+            else:
+                p._entries.move_to_end(key)
+                p.hits += 1
+            return entry
+
+    def _put(p, key, entry):
+        with p._lock:
+            p._entries[key] = entry
+            if len(p._entries) > p.maxsize:
+                p._entries.popitem(last=False)
+
+    def split(p, s, mode=SPLIT_SHELL32):
+        "Cached split"
+        key = (0, s, mode)
+        entry = p._get(key)
+        if entry is None:
+            entry = tuple(split(s, mode))
+            p._put(key, entry)
+        return list(entry)
+
+    def cmd_split(p, s, mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None):
+        "Cached cmd_split"
+        if env is None: env = os.environ
+        key = (1, s, mode)
+        entry = p._get(key, env)
+        if entry is None:
+            recorder = None
+            if mode & (CMD_VAREXPAND|CMD_EXCLMARK):
+                recorder = _EnvRecorder(env)
+            entry = (tuple(cmd_split(s, mode, recorder or env)), ())
+            if recorder:
+                entry = (entry[0], tuple(recorder.used.items()))
+            p._put(key, entry)
+        return list(entry[0])
+
+    def quote(p, s):
+        "Cached quote"
+        key = (2, s)
+        entry = p._get(key)
+        if entry is None:
+            entry = quote(s)
+            p._put(key, entry)
+        return entry
+
+    def cache_info(p):
+        "Report cache statistics"
+        with p._lock:
+            return CacheInfo(p.hits, p.misses, p.maxsize, len(p._entries))
+
+    def cache_clear(p):
+        "Clear the cache and its statistics"
+        with p._lock:
+            p._entries.clear()
+            p.hits = p.misses = 0
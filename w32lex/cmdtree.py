@@ -0,0 +1,204 @@
+"Typed tree of a CMD command line, built by cmd_tree while tokenizing"
+
+from . import split, _flatten
+
+_OPERATORS = ('|', '||', '&', '&&')
+
+
+class Node:
+    "Base class of cmd_tree nodes"
+    __slots__ = ()
+    _fields = ()
+
+    def __repr__(p):
+        return '%s(%s)' % (type(p).__name__, ', '.join(['%s=%r' % (k, getattr(p, k)) for k in p._fields]))
+
+    def children(p):
+        "Return the nodes directly contained"
+        return []
+
+    def walk(p):
+        "Yield this node and all nodes it contains, depth first"
+        stack = [p]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack += reversed(node.children())
+
+    def tokens(p):
+        "Return the tokens cmd_parse emits for this node"
+        return []
+
+
+class Redirect(Node):
+    """Redirection of a handle (None if implicit), with op one of '<', '>',
+    '>>', '<<' or '<&', '>&', '>>&' (target is then a handle)"""
+    __slots__ = _fields = ('handle', 'op', 'target')
+
+    def __init__ (p, handle, op, target):
+        p.handle = handle
+        p.op = op
+        p.target = target
+
+
+class Command(Node):
+    "Simple command: its arguments, as split by cmd_split, and redirections"
+    __slots__ = ('argv', 'redirects', 'raw')
+    _fields = ('argv', 'redirects')
+
+    def __init__ (p, argv, redirects, raw):
+        p.argv = argv
+        p.redirects = redirects
+        p.raw = raw # cmd_parse tokens
+
+    def tokens(p):
+        # inner parenthesized traits are kept as lists of tokens
+        return [_flatten(tok) if type(tok) == list else tok for tok in p.raw]
+
+
+class Group(Command):
+    """Parenthesized Sequence, with the redirections following it (and any
+    unexpected argument, as a further parenthesized trait)"""
+    __slots__ = ('body',)
+    _fields = ('body', 'argv', 'redirects')
+
+    def __init__ (p, body):
+        Command.__init__(p, [], [], [])
+        p.body = body
+
+    def children(p):
+        return [p.body]
+
+
+class Pipeline(Node):
+    "Commands connected by |"
+    __slots__ = _fields = ('commands',)
+
+    def __init__ (p, commands):
+        p.commands = commands
+
+    def children(p):
+        return p.commands
+
+    def tokens(p):
+        tokens = p.commands[0].tokens()
+        for node in p.commands[1:]:
+            tokens += ['|'] + node.tokens()
+        return tokens
+
+
+class Conditional(Node):
+    "left && right, or left || right"
+    __slots__ = _fields = ('left', 'op', 'right')
+
+    def __init__ (p, left, op, right):
+        p.left = left
+        p.op = op
+        p.right = right
+
+    def children(p):
+        return [p.left, p.right]
+
+    def tokens(p):
+        return p.left.tokens() + [p.op] + p.right.tokens()
+
+
+class Sequence(Node):
+    "Items executed one after another (joined by &), optionally not echoed (@)"
+    __slots__ = _fields = ('items', 'echo_off')
+
+    def __init__ (p, items, echo_off=0):
+        p.items = items
+        p.echo_off = echo_off
+
+    def children(p):
+        return p.items
+
+    def tokens(p):
+        tokens = ['@'] if p.echo_off else []
+        for i, node in enumerate(p.items):
+            if i: tokens += ['&']
+            tokens += node.tokens()
+        return tokens
+
+
+def _redirect(tok):
+    "Return a Redirect if tok is a redirection token from cmd_parse, else None"
+    handle = None
+    i = 0
+    if tok[:1] in ('0', '1', '2'):
+        handle = int(tok[0])
+        i = 1
+    for op in ('>>', '<<', '>', '<'):
+        if tok.startswith(op, i): break
+    else:
+        return None
+    rest = tok[i+len(op):]
+    if not rest:
+        return Redirect(handle, op, None) # target follows
+    if rest[0] == '&' and rest[1:] in ('0', '1', '2'):
+        return Redirect(handle, op+'&', rest[1:])
+    return None
+
+def _element(items):
+    "Build a Command, or a Group if a parenthesized trait is found, from (token, group) items"
+    node = None
+    argv = []
+    redirects = []
+    pending = None # redirection waiting for its target
+    for tok, group in items:
+        if group is not None and node is None:
+            node = group
+            continue
+        if type(tok) == list:
+            tok = _flatten(tok)
+        redirect = _redirect(tok)
+        if redirect:
+            redirects += [redirect]
+            pending = redirect if redirect.target is None else None
+            continue
+        words = split(tok)
+        if pending and words:
+            pending.target = words.pop(0)
+            pending = None
+        argv += words
+    raw = [tok for tok, group in items]
+    if node is None:
+        return Command(argv, redirects, raw)
+    node.argv, node.redirects, node.raw = argv, redirects, raw
+    return node
+
+def _sequence(tokens, groups):
+    "Build a Sequence from cmd_parse tokens; groups maps token positions to Group nodes"
+    seq = Sequence([])
+    start = 0
+    if tokens[:1] == ['@']:
+        seq.echo_off = 1
+        start = 1
+    if start == len(tokens):
+        return seq
+    cond = op = None # pending Conditional left side and operator
+    pipe = []        # commands of pending Pipeline
+    items = []       # (token, group) of pending command
+    for k in range(start, len(tokens)+1):
+        tok = tokens[k] if k < len(tokens) else '&'
+        if tok not in _OPERATORS:
+            items += [(tok, groups.get(k))]
+            continue
+        pipe += [_element(items)]
+        items = []
+        if tok == '|':
+            continue
+        node = pipe[0] if len(pipe) == 1 else Pipeline(pipe)
+        pipe = []
+        if op: node = Conditional(cond, op, node)
+        if tok == '&':
+            seq.items += [node]
+            cond = op = None
+        else:
+            cond, op = node, tok
+    return seq
+
+def _group(tokens, groups):
+    "Build the Group of a parenthesized trait from its inner tokens"
+    return Group(_sequence(tokens, groups))
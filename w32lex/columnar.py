@@ -0,0 +1,75 @@
+"Columnar split of string arrays into Arrow-style list buffers"
+
+from array import array
+from collections import namedtuple
+from itertools import accumulate, chain
+
+from . import _parser, _LIMITS, SPLIT_SHELL32
+
+_INT32_MAX = 2**31 - 1
+
+
+class SplitArray(namedtuple('SplitArray', 'values offsets row_offsets')):
+    """Arguments of an array of command lines, laid out like an Arrow
+    ListArray of strings: values is the UTF-8 bytes of all the arguments,
+    offsets the start of each argument in values (and the end of the last),
+    row_offsets the index of the first argument of each row (and the count).
+    Offsets are array('i'), or array('q') if they do not fit in 32 bits."""
+    __slots__ = ()
+
+    def __len__(p):
+        return len(p.row_offsets) - 1
+
+    def __getitem__(p, i):
+        "Return the arguments of i-th row"
+        i = range(len(p))[i]
+        offsets = p.offsets
+        return [p.values[offsets[j]:offsets[j+1]].decode('utf-8', 'surrogatepass')
+                for j in range(p.row_offsets[i], p.row_offsets[i+1])]
+
+    def to_arrow(p):
+        "Return a pyarrow ListArray (or LargeListArray) of strings sharing the buffers"
+        import pyarrow as pa
+        large = p.offsets.typecode == 'q' or p.row_offsets.typecode == 'q'
+        strings = pa.LargeStringArray if large else pa.StringArray
+        lists = pa.LargeListArray if large else pa.ListArray
+        offsets = p.offsets if not large or p.offsets.typecode == 'q' else array('q', p.offsets)
+        values = strings.from_buffers(len(offsets)-1, pa.py_buffer(offsets), pa.py_buffer(p.values))
+        return lists.from_arrays(pa.array(p.row_offsets, pa.int64() if large else pa.int32()), values)
+
+
+def _rows(arr):
+    "Return the rows of a NumPy array, pyarrow array, pandas Series or any iterable, as a list"
+    if hasattr(arr, 'to_pylist'):
+        return arr.to_pylist() # pyarrow Array or ChunkedArray
+    if hasattr(arr, 'tolist'):
+        return arr.tolist() # NumPy array or pandas Series
+    return list(arr)
+
+def _offsets(lengths):
+    "Return the cumulative offsets of lengths, as 32 bit integers if they fit"
+    offsets = array('q', list(accumulate(chain((0,), lengths))))
+    if offsets[-1] <= _INT32_MAX:
+        return array('i', offsets)
+    return offsets
+
+def split_array(arr, mode=SPLIT_SHELL32, limits=None):
+    """Split each command line (str) of a NumPy object or unicode array, a
+    pyarrow string array, a pandas Series or any iterable like split, into a
+    SplitArray of flat buffers (missing rows, like None, have no arguments)."""
+    if limits is None: limits = _LIMITS
+    rows = _rows(arr)
+    strs = [s if type(s) is str else '' for s in rows]
+    if strs and limits.length is not None:
+        limits.check('length', max(map(len, strs)))
+    argvs = list(map(_parser(mode).split, strs))
+    if limits.tokens is not None and argvs:
+        limits.check('tokens', max(map(len, argvs)))
+    args = list(chain.from_iterable(argvs))
+    text = ''.join(args)
+    values = text.encode('utf-8', 'surrogatepass')
+    if len(values) == len(text):
+        lengths = map(len, args) # ASCII: as many bytes as characters
+    else:
+        lengths = [len(arg.encode('utf-8', 'surrogatepass')) for arg in args]
+    return SplitArray(values, _offsets(lengths), _offsets(map(len, argvs)))
@@ -0,0 +1,406 @@
+"Incremental split of a command line being edited"
+
+from bisect import bisect_left, bisect_right
+
+import os
+from itertools import accumulate
+
+from . import split, split_spans, _parser, _cmd_tokens, _pairs, _variable, _delayed, _UNSPLIT, _CMD_DIALECTS, _LIMITS, \
+              NotExpected, SPLIT_SHELL32, SPLIT_ARGV0, CMD_VAREXPAND, CMD_EXCLMARK, CMD_NT, CMD_COMMAND
+
+
+
+def _prefix(a, b):
+    "Return the length of the common prefix of a and b, comparing slices in halving steps"
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _suffix(a, b, limit):
+    "Return the length of the common suffix of a and b, up to limit"
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a)-mid:len(a)-lo] == b[len(b)-mid:len(b)-lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _starts(s, mode, first, end=None):
+    """Return the starts of the arguments in s[first:end] (or up to the end of
+    s), split from a reset parser state: the slice is put between dummy
+    arguments, so that whitespace arguments at its edges are not stripped"""
+    if end is None:
+        return [first - 2 + k for k in split_spans('x ' + s[first:], mode).offsets[2::2]]
+    return [first - 2 + k for k in split_spans('x ' + s[first:end] + 'x', mode).offsets[2:-2:2]]
+
+
+class _Offsets:
+    """Sorted offsets, moved by edits: the move of the ones after the last
+    edit is kept pending (from index start on, by delta) and applied on
+    lookup; stored values are moved only between an edit and the next one,
+    so that an edit costs its distance from the previous one, not the line
+    length."""
+    __slots__ = ('values', 'start', 'delta')
+
+    def __init__ (p, values):
+        p.values = values
+        p.start = len(values)
+        p.delta = 0
+
+    def __len__(p):
+        return len(p.values)
+
+    def __getitem__(p, k):
+        if k < 0: k += len(p.values)
+        return p.values[k] + p.delta if k >= p.start else p.values[k]
+
+    def bisect_left(p, x, lo=0, hi=None):
+        values, start = p.values, p.start
+        if hi is None: hi = len(values)
+        k = bisect_left(values, x, lo, max(lo, min(start, hi)))
+        if k < start or start >= hi: return k
+        return bisect_left(values, x - p.delta, max(lo, start), hi)
+
+    def bisect_right(p, x, lo=0, hi=None):
+        values, start = p.values, p.start
+        if hi is None: hi = len(values)
+        k = bisect_right(values, x, lo, max(lo, min(start, hi)))
+        if k < start or start >= hi: return k
+        return bisect_right(values, x - p.delta, max(lo, start), hi)
+
+    def splice(p, i, j, values, delta):
+        "Replace the offsets [i:j] with values, moving the ones after by delta"
+        a, start, d = p.values, p.start, p.delta
+        if start >= len(a): d = 0
+        if not d:
+            start = j # nothing pending
+        elif start < j:
+            if start < i: a[start:i] = [v + d for v in a[start:i]]
+            start = j
+        elif j < start:
+            a[j:start] = [v + delta for v in a[j:start]]
+        a[i:j] = values
+        p.start = start + len(values) - (j - i)
+        p.delta = d + delta
+
+
+class IncrementalSplit:
+    """Split a command line like split, then keep its arguments up to date
+    while it is edited. Argument starts are checkpoints, since the parser
+    state is reset at the unquoted blank before them: an edit is re-split
+    from the start of the argument it touches, up to the first following
+    argument start where the new state is reset too (and the rest of the
+    line is unchanged), and the new arguments are spliced in."""
+    __slots__ = ('line', 'mode', 'argv', '_starts')
+
+    def __init__ (p, line='', mode=SPLIT_SHELL32):
+        p.mode = mode
+        p._split(line)
+
+    def _split(p, line):
+        "Split the whole line"
+        p.line = line
+        p.argv = split(line, p.mode)
+        p._starts = _Offsets(list(split_spans(line, p.mode).offsets[::2]))
+        return p.argv
+
+    def update(p, line):
+        "Set the line to its edited version, returning the updated arguments"
+        old = p.line
+        start = _prefix(old, line)
+        suffix = _suffix(old, line, min(len(old), len(line)) - start)
+        return p.edit(start, len(old)-suffix, line[start:len(line)-suffix])
+
+    def edit(p, start, end, text):
+        "Replace line[start:end] with text, returning the updated arguments"
+        s = p.line[:start] + text + p.line[end:]
+        starts = p._starts
+        n = len(s)
+        while n and s[n-1].isspace(): n -= 1 # like strip
+        # the argument the edit begins in (or after)
+        i = starts.bisect_right(start) - 1
+        first = starts[i] if i > -1 else 0
+        # blanks inserted before the argument are still separators
+        while first < n and s[first] in ' \t': first += 1
+        if first >= n:
+            # nothing follows: the last argument starting before n is the last
+            # one now, whitespace ones after it are stripped
+            i = starts.bisect_left(n, 0, max(i, 0)) - 1
+            first = starts[i] if i > -1 else 0
+        if i < (2 if p.mode & SPLIT_ARGV0 else 1):
+            return p._split(s)
+        delta = len(text) - (end - start)
+        mode = p.mode & ~SPLIT_ARGV0
+        parser = _parser(mode)
+        runs = parser.runs
+        pos = first
+        argv = []
+        arg = ''
+        st = 0
+        # candidate checkpoints: old arguments starting after a blank left untouched
+        for j in range(starts.bisect_right(end), len(starts)):
+            c = starts[j] + delta
+            arg, st = runs(s[pos:c], argv, arg, st)
+            pos = c
+            if st == 0 and arg == '':
+                # converged: the rest of the line splits as before
+                news = _starts(s, mode, first, c)
+                p.argv[i:j] = argv
+                starts.splice(i, j, news, delta)
+                p.line = s
+                return p.argv
+        if pos < n:
+            arg, st = runs(s[pos:n], argv, arg, st)
+            if st & parser.tail:
+                # blanks trailing an unterminated quote belong to the last argument
+                arg += s[n:]
+            argv += [arg]
+        p.argv[i:] = argv
+        news = _starts(s, mode, first) if first < n else []
+        starts.splice(i, len(starts), news, 0)
+        p.line = s
+        return p.argv
+
+
+def _rescan(s, ra, e, env, fresh=None):
+    """Expand the %variables% of s from ra, where the scan for % is reset, up
+    to the first offset not before e where it is reset again and fresh tells
+    the old scan was too (or the end). Return that offset, the expanded text
+    and the (start, end, shift) of the % pairs met: the scan is not reset
+    inside them, and values shift the offsets after them. A % left open is
+    a pair ending past the end of s."""
+    i = r = ra # text copied up to i, scan reset at r
+    out = []
+    pairs = []
+    for j, k, name in _pairs(s, '%', ra):
+        q = max(r, e)
+        if q <= j and fresh is not None and fresh(q):
+            break
+        val = None if name is None else _variable(name, env)
+        if val is not None:
+            out += [s[i:j], val]
+            i = k+1
+        r = k if name is None else k+1 # the second marker may open the next pair
+        pairs += [(j, k+1, 0 if val is None else len(val)-(k+1-j))]
+    else:
+        q = max(r, e)
+        j = s.find('%', r)
+        if not (fresh is not None and fresh(q) and (j < 0 or q <= j)):
+            if j > -1: pairs += [(j, len(s)+1, 0)]
+            q = len(s)
+    out += [s[i:q]]
+    return q, ''.join(out), pairs
+
+
+class IncrementalCmdSplit:
+    """Split a command line like cmd_split, then keep its arguments up to date
+    while it is edited. Points where the CMD parser state is reset (outside
+    quotes, parenthesis and escapes) are checkpoints, with the token index
+    and length there: an edit is parsed again from the checkpoint before it,
+    up to the first following one met again with the same state, and each
+    changed token is split again by an IncrementalSplit. %variables% are
+    expanded again from where the scan for % is reset before the edit, up to
+    where it meets the old scan: variables must keep their values while the
+    line is edited. If the line cannot be parsed, NotExpected is raised and
+    argv is None, up to the next edit."""
+    __slots__ = ('line', 'mode', 'env', 'argv', '_text', '_opens', '_ends', '_shifts',
+                 '_at', '_index', '_pos', '_tokens', '_splits', '_first', '_chars')
+
+    def __init__ (p, line='', mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None):
+        p.mode = mode
+        p.env = os.environ if env is None else env
+        p._split(line)
+
+    def _split(p, line):
+        "Parse the whole line"
+        p.line = line
+        p.argv = p._text = None
+        text = line.replace('\r', '')
+        pairs = []
+        if p.mode & CMD_VAREXPAND:
+            _, text, pairs = _rescan(text, 0, len(text), p.env)
+        marks = []
+        tokens = list(p._tokenize(text, marks.append))
+        p._tokens = tokens
+        p._splits = splits = [p._splitter(tok, None) for tok in p._delayed(tokens)]
+        p._at = _Offsets([m[0] for m in marks])
+        p._index = _Offsets([m[1] for m in marks])
+        p._chars = _Offsets(list(accumulate(map(len, tokens), initial=0)))
+        p._pos = _Offsets(p._positions(marks, p._chars.values))
+        p._opens, p._ends = _Offsets([x[0] for x in pairs]), _Offsets([x[1] for x in pairs])
+        p._shifts = _Offsets(list(accumulate([x[2] for x in pairs])))
+        p.argv = argv = _args(splits)
+        p._first = _Offsets(_firsts(splits, 0) + [len(argv)])
+        if '\r' not in line: # else offsets in line and text differ: edits parse it all
+            p._text = text
+        return argv
+
+    def _tokenize(p, text, marks, resume=None):
+        "Return the tokens of text (%variables% expanded), passing (offset, index, length) checkpoints to marks"
+        def mark(offset, index, arg):
+            return marks((offset, index, len(arg)))
+        return _cmd_tokens(text, p.mode & ~(CMD_VAREXPAND|CMD_EXCLMARK), p.env, None, marks=mark, resume=resume)
+
+    @staticmethod
+    def _positions(marks, chars):
+        """Return the position of each checkpoint in the tokens joined, given
+        where each token starts there: an edit moves only the positions after it"""
+        return [chars[i] + size for o, i, size in marks]
+
+    def _size(p, k):
+        "Return the length of the token so far at checkpoint k"
+        return p._pos[k] - p._chars[p._index[k]]
+
+    def _delayed(p, tokens):
+        "Expand !variables! in tokens, if the mode asks"
+        delayed = p.mode & CMD_EXCLMARK and _CMD_DIALECTS[p.mode & (CMD_NT|CMD_COMMAND)].delayed
+        return _delayed(tokens, delayed, p.env, _LIMITS)
+
+    def _splitter(p, tok, old):
+        "Return the IncrementalSplit of a token (old one updated, if any), or the token if cmd_split keeps it"
+        if tok in _UNSPLIT: return tok
+        if type(old) is IncrementalSplit:
+            if old.line != tok: old.update(tok)
+            return old
+        return IncrementalSplit(tok)
+
+    def update(p, line):
+        "Set the line to its edited version, returning the updated arguments"
+        old = p.line
+        start = _prefix(old, line)
+        suffix = _suffix(old, line, min(len(old), len(line)) - start)
+        return p.edit(start, len(old)-suffix, line[start:len(line)-suffix])
+
+    def edit(p, start, end, text):
+        "Replace line[start:end] with text, returning the updated arguments"
+        s = p.line[:start] + text + p.line[end:]
+        if p._text is None or '\r' in text:
+            return p._split(s)
+        try:
+            return p._edit(s, start, end, text)
+        except NotExpected:
+            p.argv = p._text = None
+            raise
+
+    def _offset(p, r):
+        "Map an offset of the line, where the scan for % is reset, to the text"
+        c = p._ends.bisect_right(r)
+        return r + p._shifts[c-1] if c else r
+
+    def _edit(p, s, start, end, text):
+        delta = len(text) - (end - start)
+        if p.mode & CMD_VAREXPAND:
+            opens, ends, shifts = p._opens, p._ends, p._shifts
+            # the % pairs from lo on are scanned again, from ra
+            lo = opens.bisect_left(start)
+            if lo and ends[lo-1] > start: lo -= 1
+            ra = min(opens[lo], start) if lo < len(opens) else start
+            def fresh(q):
+                # q-delta is not inside an old pair
+                k = opens.bisect_left(q-delta) - 1
+                return k < 0 or ends[k] <= q-delta
+            rb, exp, pairs = _rescan(s, ra, start+len(text), p.env, fresh)
+            hi = opens.bisect_left(rb-delta)
+            x0, x1 = p._offset(ra), p._offset(rb-delta)
+            base = shifts[lo-1] if lo else 0
+            cum = list(accumulate([x[2] for x in pairs], initial=base))
+            opens.splice(lo, hi, [x[0] for x in pairs], delta)
+            ends.splice(lo, hi, [x[1] for x in pairs], delta)
+            shifts.splice(lo, hi, cum[1:], cum[-1] - (shifts[hi-1] if hi else 0))
+        else:
+            x0, x1, exp = start, end, text
+        p.line = s
+        p._reparse(x0, x1, exp)
+        return p.argv
+
+    def _reparse(p, x0, x1, exp):
+        "Replace text[x0:x1] with exp, and parse again from the checkpoint before it up to convergence"
+        old = p._text
+        t = p._text = old[:x0] + exp + old[x1:]
+        dt = len(exp) - (x1 - x0)
+        at, index, tokens = p._at, p._index, p._tokens
+        # operators look up to 3 chars past their end (as in >^&1)
+        a = at.bisect_right(x0-3) - 1
+        if a > -1:
+            first = index[a]
+            resume = (at[a], tokens[first][:p._size(a)] if first < len(tokens) else '')
+        else:
+            first = 0 # from the line start
+            resume = None
+        chars = p._chars
+        base = chars[first]
+        marks = []
+        stop = []
+        def reached(m):
+            marks.append(m)
+            o, i, n = m
+            if o < x1 + dt: return 0
+            # the old parse had the same state at o-dt: same text after it,
+            # and before it for a redirection handle
+            k = at.bisect_left(o-dt)
+            if k < len(at) and at[k] == o-dt and (p._size(k) > 0) == (n > 0) and old[o-dt-1] == t[o-1]:
+                stop.append(k)
+                return 1
+            return 0
+        new = list(p._tokenize(t, reached, resume))
+        if stop:
+            k = stop[0]
+            last = index[k]
+            size = p._size(k)
+            if size:
+                # the token goes on as before
+                new[-1] += tokens[last][size:]
+                last += 1
+            k += 1
+        else:
+            k = len(at)
+            last = len(tokens)
+        # new checkpoints, then the old ones past the last one met, moved
+        keep = max(a, 0)
+        starts = list(accumulate(map(len, new), initial=base))
+        grown = starts[-1] - chars[last]
+        at.splice(keep, k, [m[0] for m in marks], dt)
+        index.splice(keep, k, [first + m[1] for m in marks], first + len(new) - last)
+        p._pos.splice(keep, k, p._positions(marks, starts), grown)
+        chars.splice(first, last, starts[:-1], grown)
+        # new tokens, updating the IncrementalSplit of the old ones in turn
+        olds = p._splits[first:last]
+        same = 0
+        while same < min(len(new), len(olds)) and new[same] == tokens[first+same]: same += 1
+        splits = []
+        for j, tok in enumerate(p._delayed(new)):
+            o = j if j < same else j - len(new) + len(olds)
+            splits += [p._splitter(tok, olds[o] if o >= same or j < same else None)]
+        # and their arguments
+        firsts, argv = p._first, p.argv
+        a0, a1 = firsts[first], firsts[last]
+        args = _args(splits)
+        argv[a0:a1] = args
+        firsts.splice(first, last, _firsts(splits, a0), len(args) - (a1 - a0))
+        tokens[first:last] = new
+        p._splits[first:last] = splits
+
+def _args(splits):
+    "Return the arguments of tokens split by IncrementalSplit, or kept"
+    argv = []
+    for x in splits:
+        if type(x) is str:
+            argv += [x]
+        else:
+            argv += x.argv
+    return argv
+
+def _firsts(splits, i):
+    "Return the index of the first argument of each token, from i"
+    firsts = []
+    for x in splits:
+        firsts += [i]
+        i += 1 if type(x) is str else len(x.argv)
+    return firsts
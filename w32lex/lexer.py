@@ -0,0 +1,112 @@
+"Streaming lexer over file-like objects, analogous to shlex.shlex"
+
+import io, sys
+from collections import deque
+
+from . import _parser, SPLIT_SHELL32
+
+_ARGV0, _LEADING, _BODY, _DONE = range(4) # lexer phases
+
+
+class W32Lexer:
+    """Split a command line read from a text stream (or a string) in chunks,
+    like split would do with the whole stream contents. Arguments are returned
+    one at a time by get_token, or by iterating over the lexer."""
+    def __init__ (p, instream=None, mode=SPLIT_SHELL32, chunksize=65536):
+        if instream is None:
+            instream = sys.stdin
+        if isinstance(instream, str):
+            instream = io.StringIO(instream)
+        p.instream = instream
+        p.mode = mode
+        p._parser = _parser(mode)
+        p.chunksize = chunksize
+        p.eof = None            # token returned at end of stream
+        p.pushback = deque()    # tokens pushed back with push_token
+        p._tokens = deque()     # arguments completed, but not yet returned
+        p._phase = _ARGV0 if mode&1 else _LEADING
+        p._arg0 = None          # argv[0] collected so far, if SPLIT_ARGV0
+        p._arg0_quoted = 0
+        p._held = ''            # held back text: trailing whitespace or backslashes
+        p._state = ('', 0)      # parser runs state
+
+    def push_token(p, tok):
+        "Push a token onto the stack, to be returned by next get_token"
+        p.pushback.appendleft(tok)
+
+    def get_token(p):
+        "Return the next argument, or eof at the end of stream"
+        if p.pushback:
+            return p.pushback.popleft()
+        while not p._tokens:
+            if p._phase == _DONE:
+                return p.eof
+            chunk = p.instream.read(p.chunksize)
+            if chunk:
+                p._feed(chunk)
+            else:
+                p._close()
+        return p._tokens.popleft()
+
+    def __iter__(p):
+        return p
+
+    def __next__(p):
+        tok = p.get_token()
+        if tok == p.eof:
+            raise StopIteration
+        return tok
+
+    def _feed(p, s):
+        if p._phase == _ARGV0:
+            # simplified parsing of the first argument, up to first space if
+            # unquoted, or second quote otherwise
+            if p._arg0 is None:
+                p._arg0 = ''
+                if s[0] == '"':
+                    p._arg0_quoted = 1
+                    s = s[1:]
+            if p._arg0_quoted:
+                i = s.find('"')
+            else:
+                i = s.find(' ')
+                j = s.find('\t', 0, i if i > -1 else len(s))
+                if j > -1: i = j
+            if i < 0:
+                p._arg0 += s
+                return
+            p._tokens += [p._arg0 + s[:i]]
+            p._phase = _LEADING
+            s = s[i+1:]
+        if p._phase == _LEADING:
+            # strip leading whitespace
+            s = s.lstrip()
+            if not s: return
+            p._phase = _BODY
+        s = p._held + s
+        # hold back trailing whitespace, which is stripped at end of stream, or
+        # trailing backslashes, which depend on the character following
+        body = s.rstrip()
+        if len(body) == len(s):
+            body = s.rstrip('\\')
+        p._held = s[len(body):]
+        if body:
+            argv = []
+            p._state = p._parser.runs(body, argv, *p._state)
+            p._tokens += argv
+
+    def _close(p):
+        if p._phase == _ARGV0 and p._arg0 is not None:
+            p._tokens += [p._arg0]
+        elif p._phase == _BODY:
+            arg, st = p._state
+            if p._held and not p._held[-1].isspace():
+                # trailing backslashes are literal
+                argv = []
+                arg, st = p._parser.runs(p._held, argv, arg, st)
+                p._tokens += argv
+            elif st & p._parser.tail:
+                # blanks trailing an unterminated quote belong to the last argument
+                arg += p._held
+            p._tokens += [arg]
+        p._phase = _DONE
@@ -0,0 +1,122 @@
+"Opt-in instrumentation of split and cmd_parse: counters, timing and a trace hook"
+
+import sys
+from time import perf_counter
+
+from . import _build, _cmd_parse, _variable, _parsers, _CMD_DIALECTS, \
+    _OTHER, _QUOTE, _CARET, _SLASH, _OPEN, _CLOSE, _REDIRECT, _OPERATOR
+
+_package = sys.modules[__package__]
+
+# names of the split rules hit by a quote in each parser state (quoted +
+# 2*quotes in a row): the third quote in a row is the """ rule
+_QUOTE_RULES = ('quote', 'quote', 'quote', 'quote', 'triple', 'triple')
+
+_CMD_RULES = {_OTHER: 'nul', _QUOTE: 'quote', _CARET: 'caret', _SLASH: 'slash', _OPEN: 'open',
+              _CLOSE: 'close', _REDIRECT: 'redirect', _OPERATOR: 'operator'}
+
+_trace = None       # trace hook
+_originals = None   # package functions and dialects replaced while instrumenting
+
+
+def _new_counters():
+    return {
+        'split': {'calls': 0, 'chars': 0, 'args': 0, 'errors': 0, 'time': 0.0,
+                  'rules': dict.fromkeys(('quote', 'triple', 'escaped', 'slashes', 'other'), 0)},
+        'cmd_parse': {'calls': 0, 'chars': 0, 'tokens': 0, 'errors': 0, 'time': 0.0, 'expansions': 0,
+                      'rules': dict.fromkeys(_CMD_RULES.values(), 0)},
+    }
+
+_counters = _new_counters()
+
+
+class _Rules:
+    """Transition table (or character classes) of an instrumented parser,
+    counting the hits of each rule and calling the trace hook"""
+    __slots__ = ('function', 'table', 'names')
+
+    def __init__ (p, function, table, names):
+        p.function = function
+        p.table = table
+        p.names = names # rule name of each key
+
+    def __getitem__(p, key):
+        name = p.names[key]
+        _counters[p.function]['rules'][name] += 1
+        if _trace: _trace(p.function, name, key)
+        return p.table[key]
+
+    def get(p, key, default=None):
+        return p.table.get(key, default)
+
+def _split_rules(QUOTE, ESCAPED, SLASHES, OTHER):
+    return (_Rules('split', QUOTE, _QUOTE_RULES), _Rules('split', ESCAPED, ('escaped',)*6),
+            _Rules('split', SLASHES, ('slashes',)*6), _Rules('split', OTHER, ('other',)*6))
+
+def _timed(function, func, size):
+    "Wrap a parser function, counting calls, characters, results (by size) and errors, and timing it"
+    c = _counters[function]
+    def wrapper(s, *args):
+        c['calls'] += 1
+        if s: c['chars'] += len(s)
+        t = perf_counter()
+        try:
+            res = func(s, *args)
+        except Exception:
+            c['errors'] += 1
+            raise
+        finally:
+            c['time'] += perf_counter() - t
+        c[size] += len(res)
+        return res
+    return wrapper
+
+def _counted_build(argv0, dialect, lead=None):
+    parser = _build(argv0, dialect, lead, _split_rules)
+    return parser._replace(split=_timed('split', parser.split, 'args'))
+
+def _counted_variable(name, env):
+    val = _variable(name, env)
+    if val is not None:
+        _counters['cmd_parse']['expansions'] += 1
+        if _trace: _trace('cmd_parse', 'expansion', name)
+    return val
+
+
+def instrument(enabled=True, trace=None):
+    """Switch instrumentation of split and cmd_parse (and the functions built
+    on them) on or off. Parsers are rebuilt once with counting transition
+    tables, so that the default ones run unchanged and cost nothing more.
+    trace, if given, is called as trace(function, rule, key) on each rule hit,
+    where key is the split parser state or the cmd_parse special character
+    (or the variable name, for expansions). Counters are per process."""
+    global _trace, _originals
+    _trace = trace if enabled else None
+    if bool(enabled) == bool(_originals):
+        return
+    if enabled:
+        _originals = (_package._build, _package._cmd_parse, _package._variable, dict(_CMD_DIALECTS))
+        _package._build = _counted_build
+        _package._cmd_parse = _timed('cmd_parse', _cmd_parse, 'tokens')
+        _package._variable = _counted_variable
+        for key, dialect in _CMD_DIALECTS.items():
+            names = {c: _CMD_RULES[cls] for c, cls in dialect.classes.items()}
+            _CMD_DIALECTS[key] = dialect._replace(classes=_Rules('cmd_parse', dialect.classes, names))
+    else:
+        _package._build, _package._cmd_parse, _package._variable, dialects = _originals
+        _CMD_DIALECTS.update(dialects)
+        _originals = None
+    # parsers are built again when next used
+    _parsers.clear()
+
+def stats():
+    """Return the counters of split and cmd_parse, collected while instrumented:
+    calls, characters, arguments (or tokens) produced, errors, cumulative time
+    in seconds, variable expansions and hits of each rule"""
+    return {function: dict(c, rules=dict(c['rules'])) for function, c in _counters.items()}
+
+def reset_stats():
+    "Reset the counters returned by stats"
+    # in place: instrumented parsers hold the counters
+    for function, c in _new_counters().items():
+        _counters[function].update(c)
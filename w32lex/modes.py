@@ -0,0 +1,133 @@
+"Split a command line in all modes at once, telling where they diverge"
+
+from collections import namedtuple
+
+from . import _DIALECTS, _parser, SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005, SPLIT_VC98
+
+# argv maps each mode to its arguments; diverge is the offset where the
+# parsing starts to differ, or None if all modes return the same arguments
+ModeSplit = namedtuple('ModeSplit', 'argv diverge')
+
+_MODES = (SPLIT_SHELL32, SPLIT_VC2005, SPLIT_VC98)
+
+# the transition tables of the dialects side by side
+_TABLES = [(tuple([t[0] for t in d.quote]), tuple([t[1] for t in d.quote]), d.escaped, d.slashes, d.other, d.tail)
+           for d in [_DIALECTS[mode] for mode in _MODES]]
+
+def _common(nexts):
+    "Return the next state all the dialects agree on (with the literal quote added), or None"
+    return nexts[0][0] if nexts.count(nexts[0]) == len(nexts) else None
+
+# next common state on a quote, on even backslashes and a quote, and on an
+# escaped quote, from each state (None where the dialects diverge)
+_ON_QUOTE = tuple([_common([(Q[st], L[st]) for Q, L, E, S, O, t in _TABLES]) for st in range(6)])
+_ON_SLASHES = tuple([_common([(Q[S[st]], L[S[st]]) for Q, L, E, S, O, t in _TABLES]) for st in range(6)])
+_ON_ESCAPED = tuple([_common([(E[st], '"') for Q, L, E, S, O, t in _TABLES]) for st in range(6)])
+
+
+def _scan(s, t0, n):
+    """Scan the quotes of the stripped line s[t0:n] with the state machines of
+    all the dialects at once, as long as they agree on the state (and on the
+    literal quote added): return the offset of the quote where they diverge
+    (n, if only the blanks trailing an unterminated quote do; None if they
+    never do), and the last argument start before it, where states are reset"""
+    OTHER = _TABLES[0][4]
+    find = s.find
+    st = 0  # the common state
+    c = t0  # last argument start
+    i = t0
+    while 1:
+        j = find('"', i, n)
+        if j < 0: j = n
+        k = j
+        if j < n:
+            while k > i and s[k-1] == '\\': k -= 1
+        if k > i:
+            if not st & 1:
+                b = max(s.rfind(' ', i, k), s.rfind('\t', i, k))
+                if b > -1: c = b + 1
+            st = OTHER[st]
+        if j == n: break
+        i = j + 1
+        if (j-k)%2:
+            st = _ON_ESCAPED[st]
+        elif k < j:
+            st = _ON_SLASHES[st]
+        else:
+            st = _ON_QUOTE[st]
+        if st is None: return j, c
+    if st & 1 and n < len(s) and len({t[5] for t in _TABLES}) > 1:
+        return n, c
+    return None, c
+
+def _argv0(s, n):
+    """Return the offset where the simplified SPLIT_ARGV0 parsing of the first
+    argument can make a difference, or None"""
+    if n == 0: return 0 if s else None # blanks: [''] or []
+    if s[0].isspace(): return 0
+    if s[0] == '"':
+        # "path" followed by a blank, with no backslash before the quote
+        end = s.find('"', 1) + 1
+        if not end or s[end-2] == '\\': return 0
+        if end < len(s) and s[end] not in ' \t': return end
+    else:
+        end = s.find(' ')
+        if end < 0: end = len(s)
+        tab = s.find('\t', 0, end)
+        if tab > -1: end = tab
+        q = s.find('"', 0, end)
+        if q > -1: return q
+        if n < end: return n # trailing whitespace kept in the first argument
+    # the rest is stripped of any whitespace, the other modes split at blanks only
+    r = end + 1
+    while r < len(s) and s[r] in ' \t': r += 1
+    if r < n and s[r].isspace(): return r
+    return None
+
+def split_all_modes(s):
+    """Split a command line with SPLIT_SHELL32, SPLIT_ARGV0, SPLIT_VC2005 and
+    SPLIT_VC98 at once, returning a ModeSplit: the arguments of each mode
+    and the offset where they diverge. The state machines run side by side
+    over the quotes up to the first divergence: arguments before it are
+    split once, and only the rest is split again in each mode."""
+    n = len(s.rstrip())
+    t0 = len(s) - len(s.lstrip()) if n else 0
+    d, c = _scan(s, t0, n) if '"' in s else (None, t0)
+    argv = {}
+    if d is None:
+        argv[SPLIT_SHELL32] = _parser(SPLIT_SHELL32).split(s)
+        argv[SPLIT_VC2005] = argv[SPLIT_SHELL32][:]
+        argv[SPLIT_VC98] = argv[SPLIT_SHELL32][:]
+    else:
+        prefix = []
+        if c > t0: _parser(SPLIT_SHELL32).runs(s[t0:c], prefix)
+        for mode in _MODES:
+            parser = _parser(mode)
+            args = prefix[:]
+            arg, st = parser.runs(s[c:n], args)
+            if st & parser.tail:
+                # blanks trailing an unterminated quote belong to the last argument
+                arg += s[n:]
+            argv[mode] = args + [arg]
+    d0 = _argv0(s, n)
+    if d0 is None:
+        argv[SPLIT_ARGV0] = argv[SPLIT_SHELL32][:]
+    else:
+        argv[SPLIT_ARGV0] = _parser(SPLIT_ARGV0).split(s)
+    diverge = None
+    first = argv[SPLIT_SHELL32]
+    if argv[SPLIT_ARGV0] != first:
+        diverge = d0
+    if d is not None and (argv[SPLIT_VC2005] != first or argv[SPLIT_VC98] != first):
+        diverge = d if diverge is None else min(d, diverge)
+    return ModeSplit(argv, diverge)
+
+def modes_agree(s):
+    """Tell if all modes split a command line the same way: lines are split
+    only if the state machines diverge, or the first argument may"""
+    n = len(s.rstrip())
+    if '"' in s:
+        t0 = len(s) - len(s.lstrip()) if n else 0
+        if _scan(s, t0, n)[0] is not None:
+            return split_all_modes(s).diverge is None
+    return _argv0(s, n) is None or split_all_modes(s).diverge is None
@@ -0,0 +1,111 @@
+"Batch splitting of many command lines, optionally on a pool of workers"
+
+import os
+from array import array
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+
+from . import cmd_split, _parser, SPLIT_SHELL32, CMD_VAREXPAND
+
+INLINE  = 'inline'  # split in the calling thread
+THREAD  = 'thread'  # thread pool (scales on free-threaded CPython builds)
+PROCESS = 'process' # process pool, chunks are sent and results packed
+
+
+def _pack(results):
+    """Pack a chunk of results in a NUL separated string and an array of
+    argument counts, which pickle far faster than lists of small strings"""
+    counts = array('I', map(len, results))
+    text = '\0'.join([arg for argv in results for arg in argv])
+    # a NUL inside some argument would break unpacking: send results as they are
+    if text.count('\0') != sum(counts)-1:
+        return results
+    return text, counts
+
+def _unpack(packed):
+    "Rebuild the results list from _pack output"
+    if type(packed) == list:
+        return packed
+    text, counts = packed
+    values = text.split('\0')
+    results = []
+    i = 0
+    for n in counts:
+        results += [values[i:i+n]]
+        i += n
+    return results
+
+def _split_chunk(lines, mode, cmd, pack, env=None):
+    "Worker: split a chunk of lines"
+    if cmd:
+        results = [cmd_split(line, mode, env) for line in lines]
+    else:
+        results = list(map(_parser(mode).split, lines))
+    if pack:
+        return _pack(results)
+    return results
+
+def _chunks(lines, chunksize):
+    "Group an iterable of lines into lists of chunksize lines"
+    chunk = []
+    for line in lines:
+        chunk += [line]
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _inline(lines, mode, cmd, env):
+    if cmd:
+        for line in lines:
+            yield cmd_split(line, mode, env)
+    else:
+        yield from map(_parser(mode).split, lines)
+
+def _run(lines, mode, cmd, executor, workers, chunksize, env=None):
+    if executor in (None, INLINE):
+        return _inline(lines, mode, cmd, env)
+    if not (isinstance(executor, Executor) or executor in (THREAD, PROCESS)):
+        raise ValueError('unknown executor %r' % (executor,))
+    return _pooled(lines, mode, cmd, executor, workers, chunksize, env)
+
+def _pooled(lines, mode, cmd, executor, workers, chunksize, env):
+    if isinstance(executor, Executor):
+        pool, owned = executor, 0
+    elif executor == THREAD:
+        pool, owned = ThreadPoolExecutor(workers), 1
+    else:
+        pool, owned = ProcessPoolExecutor(workers), 1
+    pack = isinstance(pool, ProcessPoolExecutor)
+    # keep a bounded number of chunks in flight, so that huge inputs are
+    # consumed (and results produced) at the workers pace. Executors have no
+    # public pool size: without workers, the one of the standard pools
+    # (_max_workers) is used if there, else the CPU count
+    window = 2 * (workers or getattr(pool, '_max_workers', None) or os.cpu_count() or 1)
+    pending = deque()
+    try:
+        for chunk in _chunks(lines, chunksize):
+            pending += [pool.submit(_split_chunk, chunk, mode, cmd, pack, env)]
+            if len(pending) >= window:
+                yield from _unpack(pending.popleft().result())
+        while pending:
+            yield from _unpack(pending.popleft().result())
+    finally:
+        for future in pending:
+            future.cancel()
+        if owned:
+            pool.shutdown()
+
+def split_many(lines, mode=SPLIT_SHELL32, executor=INLINE, workers=None, chunksize=1024):
+    """Split an iterable of command lines with split, returning an iterator of
+    argument lists in input order. executor may be INLINE (default), THREAD,
+    PROCESS or a concurrent.futures.Executor; workers sets the pool size (with
+    an Executor, the chunks in flight: twice its size, or the CPU count) and
+    chunksize the lines sent to a worker at once."""
+    return _run(lines, mode, 0, executor, workers, chunksize)
+
+def cmd_split_many(lines, mode=SPLIT_SHELL32|CMD_VAREXPAND, executor=INLINE, workers=None, chunksize=1024, env=None):
+    """Like split_many, but splits each line with cmd_split, expanding
+    variables from env (an Environment snapshot is best) or os.environ"""
+    return _run(lines, mode, 1, executor, workers, chunksize, env)
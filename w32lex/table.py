@@ -0,0 +1,116 @@
+"Compact, dictionary-encoded store of many argument lists"
+
+from array import array
+from collections.abc import Sequence
+
+from . import split, cmd_split, SPLIT_SHELL32, CMD_VAREXPAND
+
+
+class ArgvRow(Sequence):
+    "Read-only view of an ArgvTable row: its arguments are looked up when accessed"
+    __slots__ = ('_table', '_start', '_end')
+
+    def __init__ (p, table, start, end):
+        p._table = table
+        p._start = start
+        p._end = end
+
+    def __len__(p):
+        return p._end - p._start
+
+    def __getitem__(p, i):
+        pool, ids = p._table._pool, p._table._ids
+        if isinstance(i, slice):
+            return [pool[ids[j]] for j in range(p._start, p._end)[i]]
+        return pool[ids[range(p._start, p._end)[i]]]
+
+    def __iter__(p):
+        pool = p._table._pool
+        return map(pool.__getitem__, p._table._ids[p._start:p._end])
+
+    def __eq__(p, other):
+        if isinstance(other, (ArgvRow, list, tuple)):
+            return len(p) == len(other) and list(p) == list(other)
+        return NotImplemented
+
+    def __repr__(p):
+        return 'ArgvRow(%r)' % list(p)
+
+    def tolist(p):
+        return list(p)
+
+
+class ArgvTable:
+    """Store of argument lists, where each distinct argument is kept once in a
+    pool and rows are runs of pool ids in an array('I'), delimited by an
+    array('q') of offsets. Rows read back as ArgvRow sequences, built when
+    accessed; tables pickle as the pool and the two arrays."""
+    __slots__ = ('_pool', '_index', '_ids', '_rows')
+
+    def __init__ (p, rows=()):
+        p._pool = []            # id -> argument
+        p._index = {}           # argument -> id
+        p._ids = array('I')     # argument ids of all rows, in a row
+        p._rows = array('q', [0]) # start of each row in _ids, and end of the last
+        p.extend(rows)
+
+    def append(p, argv):
+        "Append a row of arguments (strings)"
+        if type(argv) is not list: argv = list(argv)
+        index = p._index
+        ids = list(map(index.get, argv))
+        if None in ids:
+            # new arguments (maybe repeated in the row) join the pool
+            for k, arg in enumerate(argv):
+                if ids[k] is None:
+                    i = index.get(arg)
+                    if i is None:
+                        i = index[arg] = len(p._pool)
+                        p._pool += [arg]
+                    ids[k] = i
+        p._ids.extend(ids)
+        p._rows.append(len(p._ids))
+
+    def extend(p, rows):
+        "Append many rows of arguments"
+        for argv in rows:
+            p.append(argv)
+
+    def append_line(p, s, mode=SPLIT_SHELL32):
+        "Append the arguments of a command line split by split"
+        p.append(split(s, mode))
+
+    def append_cmd_line(p, s, mode=SPLIT_SHELL32|CMD_VAREXPAND, env=None):
+        "Append the arguments of a command line split by cmd_split"
+        p.append(cmd_split(s, mode, env))
+
+    def __len__(p):
+        return len(p._rows) - 1
+
+    def __getitem__(p, i):
+        if isinstance(i, slice):
+            return [p[j] for j in range(len(p))[i]]
+        i = range(len(p))[i]
+        return ArgvRow(p, p._rows[i], p._rows[i+1])
+
+    def __iter__(p):
+        rows = p._rows
+        for i in range(len(rows) - 1):
+            yield ArgvRow(p, rows[i], rows[i+1])
+
+    def unique(p):
+        "Return the count of distinct arguments stored"
+        return len(p._pool)
+
+    def __getstate__(p):
+        # the index is rebuilt from the pool
+        return p._pool, p._ids.tobytes(), p._rows.tobytes()
+
+    def __setstate__(p, state):
+        pool, ids, rows = state
+        p._pool = pool
+        p._index = {arg: i for i, arg in enumerate(pool)}
+        p._ids = array('I')
+        p._ids.frombytes(ids)
+        p._rows = array('q')
+        p._rows.frombytes(rows)
@@ -0,0 +1,210 @@
+"Batch line templates: substitution sites located once, filled many times"
+
+import os, ntpath
+
+from . import cmd_split, NotExpected, _variable, _CMD_DIALECTS, SPLIT_SHELL32, CMD_VAREXPAND, CMD_EXCLMARK, CMD_NT, CMD_COMMAND
+
+_MODIFIERS = 'fdpnxsatz'
+_SLOT = 0xE000 # slots are marked with private use characters while tokenizing
+_SPECIAL = '"^&|<>()%!'
+_HEAD = ':;,=@' # special at line start, too
+
+
+def _tilde(val, mods, cwd):
+    "Apply the modifiers ~mods of %~mods1 or %%~modsG to a value"
+    mods = mods[1:]
+    if val[:1] == '"':
+        val = val[1:-1] if val[-1:] == '"' and len(val) > 1 else val[1:]
+    if not mods:
+        return val
+    full = ntpath.normpath(ntpath.join(cwd, val)) if cwd and val else val
+    parts = [m for m in 'dpnx' if m in mods]
+    if not parts:
+        # a, t, z need the file system: only f is rendered
+        return full if 'f' in mods else ''
+    if full[1:2] == ':':
+        drive, path = full[:2], full[2:]
+    elif full[:2] in ('\\\\', '//'):
+        drive, path = ntpath.splitdrive(full) # UNC
+    else:
+        drive, path = '', full
+    i = max(path.rfind('\\'), path.rfind('/')) + 1
+    name = path[i:]
+    j = name.rfind('.') # .ext has no name
+    if j < 0: j = len(name)
+    values = {'d': drive, 'p': path[:i], 'n': name[:j], 'x': name[j:]}
+    return ''.join([values[m] for m in parts])
+
+def _for_slot(line, i):
+    "Parse a FOR variable like G or ~nxG at line[i:], returning its slot and end, or None"
+    if line[i:i+1] == '~':
+        k = i + 1
+        while k < len(line) and line[k] in _MODIFIERS: k += 1
+        if k < len(line) and line[k].isalpha():
+            return ('for', line[k], line[i:k]), k+1
+        if k > i + 1:
+            # the last modifier is the variable itself
+            return ('for', line[k-1], line[i:k-1]), k
+        return None
+    if line[i:i+1].isalpha():
+        return ('for', line[i], ''), i+1
+    return None
+
+def _sites(line, mode):
+    """Split a batch line into literal strings and substitution slots, like
+    the percent expansion phase of CMD does: %0-%9, %*, %~mods0-9, %VAR%
+    (if mode has CMD_VAREXPAND), %% and FOR variables %%G, %%~modsG"""
+    pieces = [] # literals and slot tuples
+    i = 0
+    find = line.find
+    while 1:
+        j = find('%', i)
+        if j < 0:
+            pieces += [line[i:]]
+            return pieces
+        pieces += [line[i:j]]
+        c = line[j+1:j+2]
+        i = j + 2
+        if c == '%':
+            slot = _for_slot(line, i)
+            if slot:
+                pieces += [slot[0]]
+                i = slot[1]
+            else:
+                pieces += ['%']
+        elif c.isdigit():
+            pieces += [('arg', int(c), '')]
+        elif c == '*':
+            pieces += [('all', 0, '')]
+        elif c == '~':
+            k = i
+            while k < len(line) and line[k] in _MODIFIERS: k += 1
+            if line[k:k+1].isdigit():
+                pieces += [('arg', int(line[k]), line[i-1:k])]
+                i = k + 1
+            else:
+                pieces += ['%~'] # invalid, kept
+        else:
+            k = find('%', j+1)
+            if k < 0:
+                i = j + 1 # a lone % is dropped
+            elif mode & CMD_VAREXPAND:
+                pieces += [('env', line[j+1:k], '')]
+                i = k + 1
+            else:
+                pieces += [line[j:k+1]]
+                i = k + 1
+
+
+class CmdTemplate:
+    """Batch line compiled by compile_cmd: its substitution slots are found,
+    and the line tokenized with the slots in place, once. render fills the
+    slots; when every value is plain (no blanks or characters special at
+    its place) the precomputed arguments are filled in, with no parsing."""
+    __slots__ = ('mode', '_pieces', '_slots', '_argv', '_checks')
+
+    def __init__ (p, line, mode=SPLIT_SHELL32|CMD_VAREXPAND):
+        p.mode = mode
+        p._slots = []   # distinct slots
+        index = {}
+        pieces = []     # literals and slot indexes
+        for piece in _sites(line, mode):
+            if type(piece) == tuple:
+                if piece not in index:
+                    index[piece] = len(p._slots)
+                    p._slots += [piece]
+                piece = index[piece]
+            elif not piece:
+                continue
+            pieces += [piece]
+        p._pieces = pieces
+        p._argv = p._checks = None
+        p._compile()
+
+    def _compile(p):
+        "Tokenize the line with slots marked by private use characters"
+        if len(p._slots) > 0x1000: return
+        text = ''.join([chr(_SLOT+x) if type(x) == int else x for x in p._pieces])
+        literals = ''.join([x for x in p._pieces if type(x) != int])
+        for c in literals:
+            if _SLOT <= ord(c) < _SLOT+0x1000: return
+        if p.mode & CMD_EXCLMARK and '!' in literals: return
+        try:
+            argv = cmd_split(text, p.mode & ~(CMD_VAREXPAND|CMD_EXCLMARK))
+        except NotExpected:
+            return # maybe not, once filled
+        # characters a value must not contain to be filled in
+        checks = [_SPECIAL] * len(p._slots)
+        # the line start, past leading chars dropped by cmd_parse, and its first word
+        dialect = _CMD_DIALECTS[p.mode & (CMD_NT|CMD_COMMAND)]
+        t = text.lstrip(dialect.leading)
+        if t[:1] and t[0] in dialect.single: t = t[1:]
+        head = len(text) - len(t.lstrip('@'))
+        blank = text.find(' ', head) # as the / rule has it
+        if text[head:head+1] == '^':
+            escaped = head + 1 # char escaped (or line ignored) at line start
+        else:
+            escaped = -1
+        start = _HEAD + dialect.leading + dialect.start_escape + dialect.start_ignore
+        for k, c in enumerate(text):
+            x = ord(c) - _SLOT
+            if 0 <= x < len(p._slots):
+                if k == head or k == escaped: checks[x] += start
+                if blank < 0 or k < blank: checks[x] += '/'
+                # backslashes before a (maybe escaped) quote are escapes
+                e = k + 1
+                while text[e:e+1] == '\\': e += 1
+                if text[e:e+1] in ('"', '^') or 0 <= ord(text[e:e+1] or ' ') - _SLOT < len(p._slots):
+                    checks[x] += '\\'
+        p._checks = [frozenset(check) for check in checks]
+        p._argv = []
+        for arg in argv:
+            parts = []
+            i = 0
+            for k, c in enumerate(arg):
+                x = ord(c) - _SLOT
+                if 0 <= x < len(p._slots):
+                    if k > i: parts += [arg[i:k]]
+                    parts += [x]
+                    i = k + 1
+            if not parts:
+                p._argv += [arg]
+                continue
+            if i < len(arg): parts += [arg[i:]]
+            p._argv += [parts]
+
+    def _value(p, slot, args, forvars, env, cwd):
+        kind, key, mods = slot
+        if kind == 'arg':
+            val = args[key] if key < len(args) else ''
+            return _tilde(val, mods, cwd) if mods else val
+        if kind == 'all':
+            return ' '.join(args[1:])
+        if kind == 'env':
+            return _variable(key, env) or '' # undefined variables expand to nothing
+        if forvars and key in forvars:
+            return _tilde(forvars[key], mods, cwd) if mods else forvars[key]
+        return '%' + mods + key # not a FOR variable: %%G is %G
+
+    def render(p, args=(), forvars=None, env=None, cwd=None):
+        """Return the cmd_split arguments of the line with batch arguments %0-%9
+        (and %*) from args, FOR variables from forvars (a mapping of letters),
+        and variables from env or os.environ. Paths of %~f modifiers are
+        made full against cwd, if given (a, t and z render nothing)."""
+        if env is None: env = os.environ
+        values = [p._value(slot, args, forvars, env, cwd) for slot in p._slots]
+        if p._argv is not None and p._plain(values):
+            return [arg if type(arg) == str else ''.join([values[x] if type(x) == int else x for x in arg])
+                    for arg in p._argv]
+        line = ''.join([values[x] if type(x) == int else x for x in p._pieces])
+        return cmd_split(line, p.mode & ~CMD_VAREXPAND, env)
+
+    def _plain(p, values):
+        "Tell if the values can be filled in the precomputed arguments"
+        for val, check in zip(values, p._checks):
+            if val.split() != [val] or not check.isdisjoint(val): return 0 # empty, with blanks or specials
+        return 1
+
+def compile_cmd(line, mode=SPLIT_SHELL32|CMD_VAREXPAND):
+    "Compile a batch line into a CmdTemplate, to render it with many bindings"
+    return CmdTemplate(line, mode)